@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Measure the cold-start time of the `ctx` command line.
+
+Each sample runs a fresh interpreter on `python -m shellctx.ctx`, against a
+temporary CTX_HOME holding a context of the given size.
+
+    $ python3 benchmarks/startup.py
+    $ python3 benchmarks/startup.py --budget 10 get name
+    $ python3 benchmarks/startup.py --importtime get
+
+The time of a bare `python -c pass` is measured first, and the overhead of
+each command is reported on top of it. With --budget, the exit status is 1
+if the median overhead of any command is over the budget in milliseconds.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOW = '1970-01-01T00:00:00.123456'
+
+
+def make_home(size):
+    home = tempfile.mkdtemp(prefix='ctx-bench-')
+    d = {'key%i' % i: [NOW, 'value %i' % i] for i in range(size)}
+    with open(os.path.join(home, 'main.json'), 'w') as fid:
+        json.dump(d, fid, indent=4)
+    # a change writes the key index and the snapshot, as in normal use
+    subprocess.run(command_argv('set') + ['key0', 'value 0'],
+                   env=environ(home), check=True, stdout=subprocess.DEVNULL)
+    return home
+
+
+def command_argv(cmd):
+    argv = [sys.executable, '-m', 'shellctx.ctx', cmd]
+    if cmd == 'get':
+        argv.append('key0')
+    return argv
+
+
+def environ(home):
+    env = dict(os.environ)
+    env['CTX_HOME'] = home
+    env['PYTHONPATH'] = ROOT
+    env.pop('CTX_NAME', None)
+    env.pop('CTX_VERBOSE', None)
+    return env
+
+
+def time_command(cmd, home, repeat):
+    argv = command_argv(cmd)
+    env = environ(home)
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(argv, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def python_baseline(repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def importtime(cmd, home, top=15):
+    argv = command_argv(cmd)
+    argv.insert(1, '-X')
+    argv.insert(2, 'importtime')
+    proc = subprocess.run(argv, env=environ(home), check=True,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE)
+    rows = []
+    for line in proc.stderr.decode('utf8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[12:].split('|', 2)
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    rows.sort(reverse=True)
+    print('import times for %r (microseconds)' % cmd)
+    print('%12s %12s  %s' % ('cumulative', 'self', 'module'))
+    for cumulative_us, self_us, module in rows[:top]:
+        print('%12i %12i  %s' % (cumulative_us, self_us, module))
+    print()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('commands', nargs='*',
+                        default=['get', 'name', 'keys'])
+    parser.add_argument('--size', type=int, default=100,
+                        help='number of keys in the context')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=None,
+                        help='maximum median milliseconds per command, '
+                             'over the bare interpreter')
+    parser.add_argument('--importtime', action='store_true',
+                        help='show the slowest imports of each command')
+    opts = parser.parse_args(args)
+
+    home = make_home(opts.size)
+    try:
+        base = statistics.median(python_baseline(opts.repeat))
+        print('%-10s %8.2f ms median' % ('python', base))
+
+        status = 0
+        for cmd in opts.commands:
+            if opts.importtime:
+                importtime(cmd, home)
+            samples = time_command(cmd, home, opts.repeat)
+            med = statistics.median(samples)
+            line = '%-10s %8.2f ms median, %8.2f ms min, %8.2f ms overhead' % (
+                cmd, med, min(samples), med - base)
+            if opts.budget is not None and med - base > opts.budget:
+                line += '  OVER BUDGET (%.2f ms)' % opts.budget
+                status = 1
+            print(line)
+    finally:
+        shutil.rmtree(home)
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Benchmark the core commands across context sizes and chain depths.
+
+Each command runs through `ctx.context()` with a fixed `_now`, against a
+temporary CTX_HOME holding contexts of the given sizes. The cold start of
+`scripts/ctx` is measured in fresh processes. The results are written as
+JSON, and can be checked against an earlier run.
+
+    $ python3 benchmarks/suite.py -o results.json
+    $ python3 benchmarks/suite.py --sizes 10,1000 --chains 1,2 -o new.json
+    $ python3 benchmarks/suite.py --sizes 10,1000 --compare results.json
+
+With --compare, the exit status is 1 if the median of any benchmark is
+more than --threshold times, and --min-ms milliseconds over, the median
+of the same benchmark in the given results file.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from shellctx import ctx
+
+
+NOW = '1970-01-01T00:00:00.123456'
+UPDATE_LINES = 1000
+
+
+def make_context(home, name, size, prefix='key'):
+    # write a context of `size` keys, with a log of the same length
+    d = {'%s%i' % (prefix, i): [NOW, 'value %i' % i] for i in range(size)}
+    with open(os.path.join(home, name + '.json'), 'wb') as fid:
+        fid.write(ctx._dumps_context(d).encode('utf8'))
+    log = ((NOW, 'set', k, v[1]) for k, v in d.items())
+    ctx._append_log(os.path.join(home, name + '.log'), log)
+
+
+def make_chain(home, size, depth):
+    # split `size` keys over `depth` chained contexts, the looked up key
+    # is in the last one
+    names = ['chain%i' % i for i in range(depth)]
+    for n, name in enumerate(names):
+        make_context(home, name, max(1, size // depth), prefix='c%ikey' % n)
+    return '+'.join(names), 'c%ikey0' % (depth - 1)
+
+
+def run(argv, environ):
+    ctx.context(argv, environ, io.StringIO(), io.StringIO(), _now=NOW)
+
+
+def time_call(argv, environ, repeat):
+    run(argv, environ)  # warm up, e.g. to write a snapshot
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run(argv, environ)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def time_cold_start(argv, environ, repeat):
+    env = dict(os.environ)
+    env.update(environ)
+    env['PYTHONPATH'] = ROOT
+    env.pop('CTX_VERBOSE', None)
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(argv, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def script_argv():
+    if sys.platform.startswith('win'):
+        return [os.path.join(ROOT, 'scripts', 'ctx.bat')]
+    return ['sh', os.path.join(ROOT, 'scripts', 'ctx')]
+
+
+def result(name, size, depth, samples):
+    return {
+        'benchmark': name,
+        'keys': size,
+        'chain': depth,
+        'samples': len(samples),
+        'min_ms': min(samples),
+        'median_ms': statistics.median(samples),
+        'mean_ms': statistics.mean(samples),
+        }
+
+
+def bench_size(size, opts):
+    home = tempfile.mkdtemp(prefix='ctx-bench-')
+    try:
+        environ = {'CTX_HOME': home, 'CTX_NAME': 'main'}
+        make_context(home, 'main', size)
+        update_file = os.path.join(home, 'update.txt')
+        with open(update_file, 'w') as fid:
+            for i in range(UPDATE_LINES):
+                fid.write('update%i=value %i\n' % (i, i))
+
+        commands = [
+            ('set', ('set', 'key0', 'new value')),
+            ('get', ('get', 'key0')),
+            ('items', ('items',)),
+            ('_fullitems', ('_fullitems',)),
+            ('_fullitems --limit', ('_fullitems', '--limit', '20')),
+            ('update', ('update', update_file)),
+            ('entry', ('entry', 'note', 'value')),
+            ('log', ('log',)),
+            ('log --tail', ('log', '--tail', '10')),
+            ]
+        for name, args in commands:
+            if name in opts.skip:
+                continue
+            samples = time_call(('ctx',) + args, environ, opts.repeat)
+            yield result(name, size, 1, samples)
+
+        for depth in opts.chains:
+            if depth < 2 or 'chain' in opts.skip:
+                continue
+            chain, key = make_chain(home, size, depth)
+            env = dict(environ, CTX_NAME=chain)
+            for name, args in [('chain get', ('get', key)),
+                               ('chain keys', ('keys',))]:
+                samples = time_call(('ctx',) + args, env, opts.repeat)
+                yield result(name, size, depth, samples)
+
+        if 'cold' not in opts.skip:
+            argv = script_argv() + ['get', 'key0']
+            samples = time_cold_start(argv, environ, opts.repeat)
+            yield result('cold get', size, 1, samples)
+    finally:
+        shutil.rmtree(home)
+
+
+def compare(results, baseline_file, threshold, min_ms):
+    # report the benchmarks slower than `threshold` times the baseline,
+    # ignoring differences under `min_ms` as noise
+    with open(baseline_file, 'r') as fid:
+        baseline = json.load(fid)
+    old = {(r['benchmark'], r['keys'], r['chain']): r['median_ms']
+           for r in baseline['results']}
+    status = 0
+    for r in results:
+        key = (r['benchmark'], r['keys'], r['chain'])
+        if key not in old:
+            continue
+        ratio = r['median_ms'] / old[key] if old[key] else 1.0
+        if ratio > threshold and r['median_ms'] - old[key] > min_ms:
+            status = 1
+            print('REGRESSION %-12s keys=%-8i chain=%i  %8.2f ms -> %8.2f ms '
+                  '(x%.2f)' % (key + (old[key], r['median_ms'], ratio)),
+                  file=sys.stderr)
+    return status
+
+
+def int_list(s):
+    return [int(i) for i in s.split(',') if i]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int_list,
+                        default=[10, 1000, 100000, 1000000],
+                        help='comma-separated numbers of keys')
+    parser.add_argument('--chains', type=int_list, default=[1, 2, 4, 8],
+                        help='comma-separated chain depths')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--skip', type=lambda s: s.split(','), default=[],
+                        help='comma-separated benchmarks to skip, '
+                             'with "chain" and "cold" for the groups')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON results file, default stdout')
+    parser.add_argument('--compare', default=None,
+                        help='earlier JSON results to check against')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    parser.add_argument('--min-ms', type=float, default=1.0)
+    opts = parser.parse_args(args)
+
+    results = []
+    for size in opts.sizes:
+        for r in bench_size(size, opts):
+            print('%-12s keys=%-8i chain=%i  %10.2f ms median' % (
+                r['benchmark'], r['keys'], r['chain'], r['median_ms']),
+                file=sys.stderr)
+            results.append(r)
+
+    report = {
+        'version': ctx.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': opts.repeat,
+        'results': results,
+        }
+    text = json.dumps(report, indent=4)
+    if opts.output is None:
+        print(text)
+    else:
+        with open(opts.output, 'w') as fid:
+            fid.write(text + '\n')
+
+    if opts.compare is not None:
+        return compare(results, opts.compare, opts.threshold,
+                       opts.min_ms)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
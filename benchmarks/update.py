@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Benchmark bulk loading with `ctx update`.
+
+Writes a file of `key=value` lines, loads it into an empty context through
+`ctx.context()` and checks that the stored timestamps keep the input order.
+
+    $ python3 benchmarks/update.py
+    $ python3 benchmarks/update.py --lines 100000 --backend sqlite
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from shellctx import ctx
+
+
+NOW = '1970-01-01T00:00:00.123456'
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--backend', default='json',
+                        choices=sorted(ctx._BACKENDS))
+    opts = parser.parse_args(args)
+
+    home = tempfile.mkdtemp(prefix='ctx-bench-')
+    try:
+        kv_file = os.path.join(home, 'kv.txt')
+        with open(kv_file, 'w') as fid:
+            for i in range(opts.lines):
+                fid.write('key%07i=value %i\n' % (i, i))
+
+        environ = {'CTX_HOME': home, 'CTX_BACKEND': opts.backend}
+        t0 = time.perf_counter()
+        ctx.context(('ctx', 'update', kv_file), environ,
+                    io.StringIO(), io.StringIO(), _now=NOW)
+        elapsed = time.perf_counter() - t0
+
+        backend = ctx._open_backend(home, 'main', environ)
+        items = sorted(backend.items(), key=lambda kv: kv[1][0])
+        keys = [k for k, v in items]
+        assert keys == sorted(keys), 'input order not preserved'
+        assert len(keys) == opts.lines
+
+        print('update %i lines (%s): %.2f s, %.0f lines/s' % (
+            opts.lines, opts.backend, elapsed, opts.lines / elapsed))
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
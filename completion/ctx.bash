@@ -0,0 +1,47 @@
+# bash completion for ctx, from `ctx _completion bash`
+#   eval "$(ctx _completion bash)"
+
+_ctx_keys() {
+    # keys of the active context chain starting with $1
+    local home="${CTX_HOME:-$HOME/.ctx}" name part
+    local -a files=()
+    name="${CTX_NAME:-$(cat "$home/_name.txt" 2>/dev/null)}"
+    local IFS='+'
+    for part in ${name:-main}; do
+        part="${part// /}"
+        [ -f "$home/$part.keys" ] && files+=("$home/$part.keys")
+    done
+    [ ${#files[@]} -gt 0 ] || return
+    P="$1" awk 'FNR > 1 && index($0, ENVIRON["P"]) == 1' "${files[@]}" |
+        sort -u
+}
+
+_ctx_contexts() {
+    local home="${CTX_HOME:-$HOME/.ctx}" f
+    for f in "$home"/*.json "$home"/*.sqlite; do
+        [ -e "$f" ] || continue
+        f="${f##*/}"
+        printf '%s\n' "${f%.*}"
+    done
+}
+
+_ctx() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" cmd="${COMP_WORDS[1]}"
+    COMPREPLY=()
+    if [ "$COMP_CWORD" -eq 1 ]; then
+        COMPREPLY=($(compgen -W "args batch clear copy daemon del dosvar dryexec dryrun dryshell entry exec execvp get help import items keys log map message migrate msg name now rename run set setpath shell stats switch txn update version waitpid" -- "$cur"))
+        return
+    fi
+    local IFS=$'\n'
+    case "$cmd" in
+        switch)
+            [ "$COMP_CWORD" -eq 2 ] &&
+                COMPREPLY=($(compgen -W "$(_ctx_contexts)" -- "$cur")) ;;
+        del|items|shell|dryshell)
+            COMPREPLY=($(_ctx_keys "$cur")) ;;
+        get|set|setpath|exec|dryexec|execvp|rename|copy|dosvar|map|run|dryrun)
+            [ "$COMP_CWORD" -eq 2 ] && COMPREPLY=($(_ctx_keys "$cur")) ;;
+    esac
+}
+
+complete -o default -F _ctx ctx
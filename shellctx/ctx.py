@@ -20,8 +20,14 @@ Updates
 
 import os
 import sys
-import json
 import collections
+import collections.abc
+
+# the start of the import, for the CTX_PROFILE timings, see `_Profile`
+_import_start = None
+if os.environ.get('CTX_PROFILE', '0') != '0':
+    import time
+    _import_start = time.perf_counter()
 
 __version__ = '0.2.0.dev0'
 
@@ -32,12 +38,1712 @@ def print(*args, **kw):
     return builtins.print(*args, **kw)
 
 
-import datetime
 def get_now():
+    import datetime
     now = datetime.datetime.now().isoformat()
     return now
 
 
+def _unique_times(now):
+    """Yield `now`, then timestamps one microsecond apart after it.
+
+    This gives bulk changes ordered and unique timestamps without
+    waiting for the clock to move.
+    """
+    import datetime
+    t = datetime.datetime.fromisoformat(now)
+    step = datetime.timedelta(microseconds=1)
+    yield now
+    while True:
+        t += step
+        yield t.isoformat(timespec='microseconds')
+
+
+# Compression, enabled by CTX_COMPRESS and CTX_COMPRESS_MIN. Compressed
+# context files are gzip, told apart from JSON by their magic number.
+# Compressed values are zlib data in base64 behind a marker, which a value
+# from the command line cannot start with as it holds a NUL. The log is
+# not compressed: it grows by a record or two at a time, which gzip makes
+# larger, and it is read from the end for `log --tail`.
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_PACKED = '\0z:'
+
+
+def _compress_options(environ):
+    # the gzip level for files, 0 for none, and the length from which
+    # values are compressed, None for never
+    level = int(environ.get('CTX_COMPRESS', 0))
+    value_min = environ.get('CTX_COMPRESS_MIN')
+    if value_min is not None:
+        value_min = int(value_min)
+    return level, value_min
+
+
+def _gzip(data, level):
+    import gzip
+    return gzip.compress(data, level, mtime=0)
+
+
+def _gunzip(data):
+    import gzip
+    return gzip.decompress(data)
+
+
+def _pack_value(value, value_min=None):
+    """Return a value to store, compressed if it is `value_min` or longer.
+
+    Values starting with the marker are always compressed, so that the
+    marker is unambiguous.
+    """
+    if not isinstance(value, str):
+        return value
+    marked = value.startswith(_PACKED)
+    if not marked and (value_min is None or len(value) < value_min):
+        return value
+    import zlib
+    import base64
+    packed = _PACKED + base64.b64encode(zlib.compress(
+        value.encode('utf8', 'surrogatepass'))).decode('ascii')
+    if len(packed) >= len(value) and not marked:
+        return value  # does not compress
+    return packed
+
+
+def _unpack_value(value):
+    """Return a stored value, decompressed if `_pack_value` compressed it."""
+    if not (isinstance(value, str) and value.startswith(_PACKED)):
+        return value
+    import zlib
+    import base64
+    return zlib.decompress(base64.b64decode(value[len(_PACKED):])).decode(
+        'utf8', 'surrogatepass')
+
+
+# The change log is stored as JSON Lines, one record per line, so that
+# a mutation only appends to the file. Older versions stored the whole
+# log as a single JSON array, which is migrated on the next append.
+
+def _is_legacy_log(fid):
+    # The legacy array was written by json.dumps(log, indent=4), so its
+    # first line is a lone '['. JSON Lines records are flat lists, and a
+    # first line that does not parse is a record cut short, not a legacy
+    # log.
+    import json
+    fid.seek(0)
+    line = fid.readline()
+    if not line.endswith(b'\n'):
+        return False
+    if line.strip() == b'[':
+        return True
+    try:
+        rec = json.loads(line.decode('utf8'))
+    except ValueError:
+        return False
+    return isinstance(rec, list) and bool(rec) and isinstance(rec[0], list)
+
+
+def _iter_log(log_file, since=None):
+    """Lazily yield the records of a change log.
+
+    If `since` is given, only records with a timestamp at or after it are
+    returned. The log is not in time order, e.g. a transaction appends the
+    records it staged earlier, so the reading starts at the offset given
+    by the log index, see `_log_index_start()`, and every record is
+    checked.
+    """
+    import json
+    if not os.path.exists(log_file):
+        return
+    with open(log_file, 'rb') as fid:
+        if _is_legacy_log(fid):
+            fid.seek(0)
+            log = json.loads(fid.read().decode('utf8'))
+            if since is not None:
+                log = [rec for rec in log if rec[0] >= since]
+            yield from log
+            return
+
+        if since is None:
+            fid.seek(0)
+        else:
+            fid.seek(_log_index_start(log_file, since))
+
+        for line in fid:
+            if not line.endswith(b'\n'):
+                break  # incomplete trailing record
+            if line.strip():
+                rec = json.loads(line.decode('utf8'))
+                if since is None or rec[0] >= since:
+                    yield rec
+
+
+def _dumps_record(rec):
+    # json.dumps of a log record, formatted directly for string fields
+    import json
+    from json.encoder import encode_basestring_ascii as enc
+    try:
+        return '[%s]' % ', '.join(
+            ['null' if x is None else enc(x) for x in rec])
+    except TypeError:
+        return json.dumps(rec)
+
+
+# Each JSON Lines log has an index in `<name>.logidx`, with an entry of
+# fixed size for each append: the greatest timestamp logged up to and
+# including the append, and the start and end offsets of its records. The
+# greatest timestamps only grow, so the first append that may hold a
+# record at or after some time is found by bisection, even though the
+# records themselves are not in time order.
+
+_LOG_INDEX = '<48sQQ'
+
+
+def _log_index_file(log_file):
+    return os.path.splitext(log_file)[0] + '.logidx'
+
+
+def _log_index_last(idx_file):
+    # the last entry of a log index as (tstamp, start, end), or None
+    import struct
+    size = struct.calcsize(_LOG_INDEX)
+    try:
+        with open(idx_file, 'rb') as fid:
+            end = fid.seek(0, os.SEEK_END)
+            if not end or end % size:
+                return None
+            fid.seek(end - size)
+            t, start, end = struct.unpack(_LOG_INDEX, fid.read(size))
+    except OSError:
+        return None
+    return t.rstrip(b'\0'), start, end
+
+
+def _log_index_start(log_file, since):
+    """Return the log offset to read from for the records since a time.
+
+    The start of the first append whose greatest timestamp is at or after
+    `since`. Without an index matching the log, it is the start of the
+    log.
+    """
+    import struct
+    size = struct.calcsize(_LOG_INDEX)
+    bsince = since.encode('utf8')
+    idx_file = _log_index_file(log_file)
+    last = _log_index_last(idx_file)
+    if last is None or last[2] > os.path.getsize(log_file):
+        return 0
+    with open(idx_file, 'rb') as fid:
+        count = fid.seek(0, os.SEEK_END) // size
+
+        def entry(i):
+            fid.seek(i * size)
+            return struct.unpack(_LOG_INDEX, fid.read(size))
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entry(mid)[0].rstrip(b'\0') >= bsince:
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo == count:
+            return last[2]  # no indexed record is recent enough
+        return entry(lo)[1]
+
+
+def _log_index_append(log_file, start, end, tstamp):
+    """Add the entry of an append of `start` to `end` to the log index.
+
+    An index that does not end at `start`, e.g. after the log was trimmed
+    or written by an older version, is rebuilt from the log first.
+    """
+    import json
+    import struct
+    idx_file = _log_index_file(log_file)
+    last = _log_index_last(idx_file) if start else None
+    entries = []  # (greatest timestamp, start, end)
+    if last is not None and last[2] == start:
+        mode = 'ab'
+        tstamp = max(tstamp, last[0])
+    else:
+        mode = 'wb'
+        if start:
+            # the greatest timestamp so far, read once
+            greatest = b''
+            pos = 0
+            with open(log_file, 'rb') as fid:
+                for line in fid:
+                    pos += len(line)
+                    if pos > start:
+                        break
+                    if line.strip():
+                        t = json.loads(line.decode('utf8'))[0]
+                        if isinstance(t, str):
+                            greatest = max(greatest, t.encode('utf8'))
+            entries.append((greatest, 0, start))
+            tstamp = max(tstamp, greatest)
+    entries.append((tstamp, start, end))
+    if any(len(t) > 48 for t, _, _ in entries):
+        # cannot be indexed, reading falls back to the whole log
+        if os.path.exists(idx_file):
+            os.remove(idx_file)
+        return
+    with open(idx_file, mode) as fid:
+        fid.write(b''.join(struct.pack(_LOG_INDEX, *e) for e in entries))
+
+
+def _tail_log(log_file, count, blocksize=65536):
+    """Return the last `count` records of a change log.
+
+    The file is read backwards from the end, so the cost depends on the
+    number of records returned rather than the size of the log.
+    """
+    import json
+    if count <= 0 or not os.path.exists(log_file):
+        return []
+    with open(log_file, 'rb') as fid:
+        if _is_legacy_log(fid):
+            return list(_iter_log(log_file))[-count:]
+
+        fid.seek(0, os.SEEK_END)
+        pos = fid.tell()
+        buf = b''
+        while pos > 0 and buf.count(b'\n') <= count:
+            start = max(0, pos - blocksize)
+            fid.seek(start)
+            buf = fid.read(pos - start) + buf
+            pos = start
+
+    lines = buf.split(b'\n')
+    lines.pop()  # incomplete trailing record, or empty
+    if pos > 0:
+        lines.pop(0)  # partial leading record
+    lines = [i for i in lines if i.strip()]
+    return [json.loads(i.decode('utf8')) for i in lines[-count:]]
+
+
+def _migrate_log(log_file):
+    import json
+    with open(log_file, 'rb') as fid:
+        log = json.loads(fid.read().decode('utf8'))
+    lines = [json.dumps(rec).encode('utf8') + b'\n' for rec in log]
+    tmp_file = log_file + '.tmp'
+    with open(tmp_file, 'wb') as fid:
+        fid.write(b''.join(lines))
+    os.replace(tmp_file, log_file)
+    idx_file = _log_index_file(log_file)
+    if os.path.exists(idx_file):
+        os.remove(idx_file)
+
+
+def _append_log(log_file, records, chunk=4096):
+    """Append records to a change log, migrating a legacy log first.
+
+    `records` may be any iterable, and is written out in chunks, and
+    the append is added to the log index. Returns the number of bytes
+    written.
+    """
+    import itertools
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return 0
+
+    if os.path.exists(log_file):
+        with open(log_file, 'rb') as fid:
+            head = fid.readline()
+            size = fid.seek(0, os.SEEK_END)
+        if head.rstrip() != b'[':
+            # drop a record cut short, even the first one, before
+            # looking at the format; a legacy array ends without a newline
+            _trim_partial(log_file, size)
+        with open(log_file, 'rb') as fid:
+            legacy = _is_legacy_log(fid)
+        if legacy:
+            _migrate_log(log_file)
+
+    nbytes = 0
+    greatest = ''
+    with open(log_file, 'ab') as fid:
+        start = fid.tell()
+        lines = []
+        for rec in itertools.chain([first], records):
+            lines.append(_dumps_record(rec).encode('utf8') + b'\n')
+            if isinstance(rec[0], str) and rec[0] > greatest:
+                greatest = rec[0]
+            if len(lines) >= chunk:
+                nbytes += fid.write(b''.join(lines))
+                lines = []
+        nbytes += fid.write(b''.join(lines))
+    _log_index_append(log_file, start, start + nbytes,
+                      greatest.encode('utf8'))
+    return nbytes
+
+
+def _trim_partial(log_file, size, blocksize=4096):
+    # drop a trailing record left behind by an interrupted write
+    if not size:
+        return
+    with open(log_file, 'r+b') as fid:
+        fid.seek(size - 1)
+        if fid.read(1) == b'\n':
+            return
+        pos = size
+        while pos > 0:
+            start = max(0, pos - blocksize)
+            fid.seek(start)
+            chunk = fid.read(pos - start)
+            idx = chunk.rfind(b'\n')
+            if idx >= 0:
+                fid.truncate(start + idx + 1)
+                return
+            pos = start
+        fid.truncate(0)
+
+
+def _dumps_context(data, value_min=None):
+    """Encode a context dictionary as json.dumps(data, indent=4) would.
+
+    The pure-Python encoder used for indented output is slow, so the
+    usual [timestamp, value] entries are formatted directly. Values of
+    `value_min` or more characters are compressed, see `_pack_value`.
+    """
+    import json
+    from json.encoder import encode_basestring_ascii as enc
+    parts = []
+    try:
+        for k, v in data.items():
+            if not isinstance(v, (list, tuple)) or len(v) != 2:
+                raise TypeError(v)
+            value = v[1]
+            if isinstance(value, str) and (
+                    value_min is not None or value.startswith(_PACKED)):
+                value = _pack_value(value, value_min)
+            parts.append('    %s: [\n        %s,\n        %s\n    ]' % (
+                enc(k), enc(v[0]), enc(value)))
+    except TypeError:
+        return json.dumps(data, indent=4)
+    if not parts:
+        return '{}'
+    return '{\n%s\n}' % ',\n'.join(parts)
+
+
+def _atomic_write(path, bdata):
+    """Replace a file with new contents, never exposing a partial write."""
+    tmp_file = '%s.%i.tmp' % (path, os.getpid())
+    with open(tmp_file, 'wb') as fid:
+        fid.write(bdata)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp_file, path)
+
+
+def _file_sig(path):
+    # identify a version of a file without reading it
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class _Profile:
+    """Timings and byte counts of the phases of a `context()` call.
+
+    Enabled by CTX_PROFILE, see `_profiled()`. The code being timed checks
+    the module-level `_profile` and adds its phases when it is set.
+    """
+    def __init__(self):
+        import time
+        self.clock = time.perf_counter
+        self.phases = []  # (name, seconds, bytes or None)
+        self.import_time = 0.0
+        self._importing = 0
+
+    def add(self, phase, t0, nbytes=None):
+        self.phases.append((phase, self.clock() - t0, nbytes))
+
+    def import_hook(self, real_import):
+        # time the modules imported lazily by the phases, which is
+        # reported on its own as it overlaps the other phases
+        def _import(*args, **kw):
+            if self._importing:
+                return real_import(*args, **kw)
+            self._importing += 1
+            t0 = self.clock()
+            try:
+                return real_import(*args, **kw)
+            finally:
+                self.import_time += self.clock() - t0
+                self._importing -= 1
+        return _import
+
+    def report(self, argv, dest, stderr):
+        if dest == '1':
+            print('ctx profile: %s' % ' '.join(argv[1:]), file=stderr)
+            for phase, secs, nbytes in self.phases:
+                s = '  %-24s %10.3f ms' % (phase, secs * 1000)
+                if nbytes is not None:
+                    s += ' %12i bytes' % nbytes
+                print(s, file=stderr)
+        else:
+            # one JSON line per call
+            import json
+            rec = {'argv': list(argv[1:]),
+                   'pid': os.getpid(),
+                   'phases': [[phase, secs * 1000, nbytes]
+                              for phase, secs, nbytes in self.phases]}
+            with open(dest, 'a') as fid:
+                fid.write(json.dumps(rec) + '\n')
+
+
+_profile = None
+
+
+# Parsed context files, keyed by path and validated by signature.
+# Disabled (None) for one-shot invocations, enabled by the daemon.
+_parsed_cache = None
+
+
+def _load_json(path, sig, cache_file=None):
+    """Load a context file. The result is shared and must not be mutated.
+
+    With a `cache_file`, the parsed dictionary is also kept on disk in
+    marshal format, and used while the signature of `path` matches.
+    """
+    if sig is None:
+        return {}
+    if _parsed_cache is not None:
+        hit = _parsed_cache.get(path)
+        if hit is not None and hit[0] == sig:
+            return hit[1]
+
+    d = None
+    if cache_file is not None:
+        if _profile is not None:
+            t0 = _profile.clock()
+        d = _read_cache(cache_file, sig)
+        if _profile is not None and d is not None:
+            _profile.add('cache ' + os.path.basename(cache_file), t0)
+
+    if d is None:
+        import json
+        if _profile is not None:
+            t0 = _profile.clock()
+        with open(path, 'rb') as fid:
+            data = fid.read()
+        if _profile is not None:
+            base = os.path.basename(path)
+            _profile.add('read ' + base, t0, len(data))
+            t0 = _profile.clock()
+        if data[:2] == _GZIP_MAGIC:
+            data = _gunzip(data)
+        d = json.loads(data.decode('utf8'))
+        if b'"\\u0000z:' in data:
+            # compressed values, see `_pack_value`
+            for v in d.values():
+                if isinstance(v, list) and len(v) == 2:
+                    v[1] = _unpack_value(v[1])
+        if _profile is not None:
+            _profile.add('decode ' + base, t0, len(data))
+        if cache_file is not None:
+            _write_cache(cache_file, sig, d)
+
+    if _parsed_cache is not None:
+        _parsed_cache[path] = (sig, d)
+    return d
+
+
+def _read_cache(cache_file, sig):
+    # return the cached dictionary, or None on a miss or a stale cache
+    import marshal
+    try:
+        with open(cache_file, 'rb') as fid:
+            cache_sig, d = marshal.load(fid)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if tuple(cache_sig) != tuple(sig):
+        return None
+    return d
+
+
+def _write_cache(cache_file, sig, d):
+    import marshal
+    try:
+        bdata = marshal.dumps((tuple(sig), d))
+    except ValueError:
+        return  # not marshallable, leave uncached
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    _atomic_write(cache_file, bdata)
+
+
+class _FileLock:
+    """Advisory lock on a side file, held by writers of a context.
+
+    Readers never take the lock. Writers replace files atomically, so a
+    reader sees either the old or the new version.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fid = None
+
+    def __enter__(self):
+        self.fid = open(self.path, 'a+b')
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            import time
+            self.fid.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.fid.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.01)
+        else:
+            fcntl.flock(self.fid.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self.fid.close()  # closing releases the lock
+        self.fid = None
+
+
+class _Snapshot:
+    """Memory-mapped, read-only snapshot of a JSON context.
+
+    The file holds the signature of the JSON file it was made from, a
+    table of record offsets sorted by key, and the records themselves, so
+    a single key is found by binary search without decoding the context.
+    """
+    magic = b'CTXSNAP1'
+    header = '<8sQQQQ'  # magic, source mtime_ns, size, inode, count
+    record = '<III'  # key, timestamp and value lengths, then the bytes
+
+    def __init__(self, mm, count):
+        import struct
+        self.mm = mm
+        self.count = count
+        self._table = struct.calcsize(self.header)
+        self._offset = struct.Struct('<Q').unpack_from
+        self._record = struct.Struct(self.record)
+
+    @classmethod
+    def write(cls, path, data, sig):
+        """Write a snapshot of `data`, the contents of a file with `sig`."""
+        import struct
+        items = []
+        for key, v in data.items():
+            if not (isinstance(v, (list, tuple)) and len(v) == 2
+                    and isinstance(v[0], str) and isinstance(v[1], str)):
+                return False  # not a context written by this program
+            items.append((key.encode('utf8', 'surrogatepass'),
+                          v[0].encode('utf8', 'surrogatepass'),
+                          v[1].encode('utf8', 'surrogatepass')))
+        items.sort()
+
+        rec = struct.Struct(cls.record)
+        pos = struct.calcsize(cls.header) + 8 * len(items)
+        offsets = []
+        records = []
+        for k, t, v in items:
+            offsets.append(pos)
+            b = rec.pack(len(k), len(t), len(v)) + k + t + v
+            records.append(b)
+            pos += len(b)
+
+        head = struct.pack(cls.header, cls.magic, sig[0], sig[1], sig[2],
+                           len(items))
+        table = struct.pack('<%iQ' % len(offsets), *offsets)
+        _atomic_write(path, b''.join([head, table] + records))
+        return True
+
+    @classmethod
+    def open(cls, path, sig):
+        """Map a snapshot, or return None if missing or out of date."""
+        import mmap
+        import struct
+        try:
+            with open(path, 'rb') as fid:
+                mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, mtime_ns, size, ino, count = struct.unpack_from(
+                cls.header, mm)
+        except struct.error:
+            magic = None
+        if magic != cls.magic or sig != (mtime_ns, size, ino):
+            mm.close()
+            return None
+        return cls(mm, count)
+
+    def close(self):
+        self.mm.close()
+
+    def _key_at(self, i):
+        pos, = self._offset(self.mm, self._table + 8 * i)
+        klen, tlen, vlen = self._record.unpack_from(self.mm, pos)
+        start = pos + self._record.size
+        return start, klen, tlen, vlen
+
+    def get(self, key):
+        """Return [timestamp, value] for a key, or None."""
+        bkey = key.encode('utf8', 'surrogatepass')
+        mm = self.mm
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, klen, tlen, vlen = self._key_at(mid)
+            k = mm[start:start + klen]
+            if k < bkey:
+                lo = mid + 1
+            elif k > bkey:
+                hi = mid
+            else:
+                start += klen
+                t = mm[start:start + tlen]
+                v = mm[start + tlen:start + tlen + vlen]
+                return [t.decode('utf8', 'surrogatepass'),
+                        v.decode('utf8', 'surrogatepass')]
+        return None
+
+
+# Each context has a sorted index of its keys in `<name>.keys`, written
+# on every store: a header line with the signature of the context file
+# it was made from, then one key per line. Shell completion reads it
+# directly, and it is only trusted when the signature matches.
+
+def _key_index_header(sig):
+    return ('#ctxkeys %r\n' % (sig,)).encode('utf8')
+
+
+def _read_key_index(path, sig):
+    # the body of an index made from the version `sig` of its context
+    try:
+        with open(path, 'rb') as fid:
+            if fid.readline() != _key_index_header(sig):
+                return None
+            return fid.read()
+    except OSError:
+        return None
+
+
+def _index_prefix(path, sig, prefix):
+    """Return the keys in an index that start with `prefix`.
+
+    The first match is found by bisecting the file, so only the matching
+    lines are read. Returns None if the index is missing or out of date.
+    """
+    bprefix = prefix.encode('utf8', 'surrogatepass')
+    try:
+        fid = open(path, 'rb')
+    except OSError:
+        return None
+    with fid:
+        if fid.readline() != _key_index_header(sig):
+            return None
+        start = fid.tell()
+        fid.seek(0, os.SEEK_END)
+
+        def line_at(offset):
+            # the start of the first line at or after `offset`
+            fid.seek(offset - 1)
+            fid.readline()
+            return fid.tell()
+
+        lo, hi = start, fid.tell()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            fid.seek(line_at(mid))
+            line = fid.readline()
+            if not line or line[:-1] >= bprefix:
+                hi = mid
+            else:
+                lo = mid + 1
+
+        keys = []
+        fid.seek(line_at(lo))
+        for line in fid:
+            if not line.startswith(bprefix):
+                break
+            keys.append(line[:-1].decode('utf8', 'surrogatepass'))
+        return keys
+
+
+def _pattern_prefix(pattern, special, quantifiers=''):
+    # the literal start that all the matches of a pattern start with
+    for i, ch in enumerate(pattern):
+        if ch in special:
+            if ch in quantifiers:
+                i -= 1  # the previous character is optional
+            return pattern[:max(i, 0)]
+    return pattern
+
+
+def _write_key_index(path, sig, keys=None, body=None):
+    """Write the index of the sorted `keys`, or an index `body`."""
+    if body is None:
+        if any('\n' in k for k in keys):
+            # cannot be indexed by line, go without an index
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        body = ''.join([k + '\n' for k in keys]).encode(
+            'utf8', 'surrogatepass')
+    _atomic_write(path, _key_index_header(sig) + body)
+
+
+# Context storage backends. A backend is a mapping of key to
+# [timestamp, value] that loads lazily, keeps changes until `flush()`
+# and owns the change log of the context.
+
+class JsonBackend(collections.abc.MutableMapping):
+    """Context stored as an indented JSON file with a JSON Lines log.
+
+    The file is read on first access. `flush()` writes it under the
+    context lock, merging the changed keys into a newer version if
+    another writer replaced the file in the meantime.
+    """
+    ext = '.json'
+
+    def __init__(self, ctx, name, environ=None):
+        environ = environ or {}
+        self.name = name
+        self.path = os.path.join(ctx, name + self.ext)
+        self.log_file = os.path.join(ctx, name + '.log')
+        self.lock_file = os.path.join(ctx, name + '.lock')
+        self.snap_file = os.path.join(ctx, name + '.snap')
+        self.index_file = os.path.join(ctx, name + '.keys')
+        self.counters_file = os.path.join(ctx, name + '.counters')
+        # contexts with at least this many keys get a snapshot
+        self.snapshot_min = int(environ.get('CTX_SNAPSHOT_MIN', 10000))
+        # gzip level of the file, and the length of compressed values
+        self.level, self.value_min = _compress_options(environ)
+        self.cache_file = None
+        if int(environ.get('CTX_CACHE', 0)):
+            self.cache_file = os.path.join(ctx, '_cache', name + '.marshal')
+        self.changed = set()
+        self.keys_changed = False  # keys added or removed, not only set
+        self._data = None
+        self._shared = False
+        self._sig = None
+        self._snap = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._sig = _file_sig(self.path)
+            self._data = _load_json(self.path, self._sig, self.cache_file)
+            self._shared = _parsed_cache is not None
+            if self._snap is False:
+                # the file changed behind our back, refresh the snapshot
+                self._write_snapshot(self._data, self._sig)
+        return self._data
+
+    def _writable(self):
+        data = self.data
+        if self._shared:
+            # copy-on-write of a dictionary from the parsed cache
+            self._data = data = dict(data)
+            self._shared = False
+        return data
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def signature(self):
+        return _file_sig(self.path)
+
+    def _snapshot(self):
+        # the snapshot answers lookups until the dictionary is loaded
+        if self._data is not None:
+            return None
+        if self._snap is None:
+            self._snap = _Snapshot.open(self.snap_file, _file_sig(self.path))
+            if self._snap is None:
+                self._snap = False
+        return self._snap or None
+
+    def _write_snapshot(self, data, sig):
+        if len(data) >= self.snapshot_min and sig is not None:
+            if _Snapshot.write(self.snap_file, data, sig):
+                return
+        if os.path.exists(self.snap_file):
+            os.remove(self.snap_file)
+
+    def __getitem__(self, key):
+        snap = self._snapshot()
+        if snap is not None:
+            v = snap.get(key)
+            if v is None:
+                raise KeyError(key)
+            return v
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        data = self._writable()
+        if key not in data:
+            self.keys_changed = True
+        data[key] = value
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        del self._writable()[key]
+        self.changed.add(key)
+        self.keys_changed = True
+
+    def __contains__(self, key):
+        snap = self._snapshot()
+        if snap is not None:
+            return snap.get(key) is not None
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
+    def prefix_keys(self, prefix):
+        """Return the sorted keys starting with `prefix`."""
+        if not self.changed:
+            keys = _index_prefix(self.index_file, self.signature(), prefix)
+            if keys is not None:
+                return keys
+        return sorted(k for k in self.data if k.startswith(prefix))
+
+    def items(self):
+        return self.data.items()
+
+    def latest(self, count=None, before=None):
+        """Return the newest (timestamp, key, value), newest first."""
+        return _latest(self.data.items(), count, before)
+
+    def update(self, d):
+        data = self._writable()
+        if not self.keys_changed and not d.keys() <= data.keys():
+            self.keys_changed = True
+        data.update(d)
+        self.changed.update(d)
+
+    def changes(self):
+        """Return the changed items and the deleted keys."""
+        data = self.data
+        updates = {k: data[k] for k in self.changed if k in data}
+        deleted = [k for k in self.changed if k not in data]
+        return updates, deleted
+
+    def rollback(self):
+        """Discard the changes that were not flushed."""
+        if self.changed:
+            self._data = None
+            self.close()
+            self._snap = None
+            self.changed.clear()
+        self.keys_changed = False
+
+    def close(self):
+        """Unmap the snapshot, which is mapped again when needed."""
+        if self._snap:
+            self._snap.close()
+            self._snap = None
+
+    def clear(self):
+        self.changed.update(self.data)
+        self.keys_changed = True
+        self._data = {}
+        self._shared = False
+
+    def flush(self, log=()):
+        """Write the changes and append `log` to the change log."""
+        data = self.data
+        if _profile is not None:
+            t0 = _profile.clock()
+        with _FileLock(self.lock_file):
+            if _profile is not None:
+                _profile.add('lock', t0)
+            sig = _file_sig(self.path)
+            # the keys are unchanged, keep the index
+            index = None
+            if not self.keys_changed:
+                index = _read_key_index(self.index_file, sig)
+            if sig != self._sig:
+                index = None
+                fresh = dict(_load_json(self.path, sig, self.cache_file))
+                for key in self.changed:
+                    if key in data:
+                        fresh[key] = data[key]
+                    else:
+                        fresh.pop(key, None)
+                data = fresh
+
+            if _profile is not None:
+                t0 = _profile.clock()
+            bdata = _dumps_context(data, self.value_min).encode('utf8')
+            if self.level:
+                bdata = _gzip(bdata, self.level)
+            if _profile is not None:
+                _profile.add('serialize', t0, len(bdata))
+                t0 = _profile.clock()
+            _atomic_write(self.path, bdata)
+            if _profile is not None:
+                _profile.add('write', t0, len(bdata))
+            self._sig = _file_sig(self.path)
+            self._write_snapshot(data, self._sig)
+            if index is None:
+                _write_key_index(self.index_file, self._sig, sorted(data))
+            else:
+                _write_key_index(self.index_file, self._sig, body=index)
+            if self.cache_file is not None:
+                _write_cache(self.cache_file, self._sig, data)
+            if _profile is not None:
+                t0 = _profile.clock()
+            nbytes = _append_log(self.log_file, log)
+            if _profile is not None:
+                _profile.add('log', t0, nbytes)
+
+            self._data = data
+            self.changed.clear()
+            self.keys_changed = False
+            if _parsed_cache is not None:
+                _parsed_cache[self.path] = (self._sig, data)
+                self._shared = True
+
+    def next_counter(self, prefix, start):
+        """Increment and return the counter of `prefix`, under the lock.
+
+        A missing counter starts from `start()`, the highest number in use.
+        """
+        import json
+        with _FileLock(self.lock_file):
+            try:
+                with open(self.counters_file, 'rb') as fid:
+                    counters = json.loads(fid.read().decode('utf8'))
+            except (OSError, ValueError):
+                counters = {}
+            num = counters.get(prefix)
+            if num is None:
+                num = start()
+            counters[prefix] = num + 1
+            _atomic_write(self.counters_file,
+                          json.dumps(counters).encode('utf8'))
+        return num + 1
+
+    def append_log(self, records):
+        with _FileLock(self.lock_file):
+            _append_log(self.log_file, records)
+
+    def stored_values(self):
+        """Return the values as stored in the file, maybe compressed."""
+        import json
+        try:
+            with open(self.path, 'rb') as fid:
+                data = fid.read()
+        except OSError:
+            return []
+        if data[:2] == _GZIP_MAGIC:
+            data = _gunzip(data)
+        return [v[1] for v in json.loads(data.decode('utf8')).values()
+                if isinstance(v, list) and len(v) == 2]
+
+    def iter_log(self, since=None):
+        return _iter_log(self.log_file, since)
+
+    def tail_log(self, count):
+        return _tail_log(self.log_file, count)
+
+    def remove(self):
+        with _FileLock(self.lock_file):
+            for f in (self.path, self.log_file,
+                      _log_index_file(self.log_file), self.snap_file,
+                      self.index_file, self.counters_file, self.cache_file):
+                if f is not None and os.path.exists(f):
+                    os.remove(f)
+
+
+class SqliteBackend(collections.abc.MutableMapping):
+    """Context stored in an SQLite database, with the log in a table.
+
+    Lookups are single-row queries on the indexed key. Changes are kept
+    in memory until `flush()`, which writes them and the log records in
+    one transaction, so the write lock is only held while committing and
+    readers are never blocked.
+    """
+    ext = '.sqlite'
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS items (
+            key TEXT PRIMARY KEY,
+            tstamp TEXT NOT NULL,
+            value TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS items_tstamp ON items (tstamp);
+        CREATE TABLE IF NOT EXISTS log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tstamp TEXT,
+            record TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS log_tstamp ON log (tstamp);
+        CREATE TABLE IF NOT EXISTS counters (
+            prefix TEXT PRIMARY KEY,
+            value INTEGER NOT NULL);
+        """
+
+    def __init__(self, ctx, name, environ=None):
+        self.name = name
+        self.path = os.path.join(ctx, name + self.ext)
+        self.log_file = self.path
+        # the pages are not compressed, only long values
+        self.value_min = _compress_options(environ or {})[1]
+        self.index_file = os.path.join(ctx, name + '.keys')
+        self.lock_file = os.path.join(ctx, name + '.lock')
+        self.changed = set()
+        self.keys_changed = False
+        self._pending = {}  # key: [timestamp, value], or None if deleted
+        self._db = None
+        self._schema_done = False
+
+    def _create(self):
+        # build the database aside and rename it into place, so that
+        # other processes never open it before it is in WAL mode
+        import sqlite3
+        with _FileLock(self.lock_file):
+            if os.path.exists(self.path):
+                return  # created by another process
+            tmp_file = '%s.%i.tmp' % (self.path, os.getpid())
+            db = sqlite3.connect(tmp_file, isolation_level=None)
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+                db.executescript(self._schema)
+            finally:
+                db.close()
+            os.replace(tmp_file, self.path)
+
+    def _conn(self, create=False):
+        # a missing database reads as empty, and is created on write
+        if self._db is None:
+            if not os.path.exists(self.path):
+                if not create:
+                    return None
+                self._create()
+            import sqlite3
+            # the journal mode is stored in the database, set on creation
+            self._db = sqlite3.connect(self.path, timeout=60,
+                                       isolation_level=None)
+        if create and not self._schema_done:
+            # add the tables missing from older databases
+            self._db.executescript(self._schema)
+            self._schema_done = True
+        return self._db
+
+    def _query(self, sql, args=()):
+        db = self._conn()
+        if db is None:
+            return []
+        return db.execute(sql, args)
+
+    def close(self):
+        """Close the connection, which is opened again when needed."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            self._schema_done = False
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def signature(self):
+        # committed changes may only be in the write-ahead log
+        return (_file_sig(self.path), _file_sig(self.path + '-wal'))
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            v = self._pending[key]
+            if v is None:
+                raise KeyError(key)
+            return list(v)
+        for tstamp, value in self._query(
+                'SELECT tstamp, value FROM items WHERE key = ?', (key,)):
+            return [tstamp, _unpack_value(value)]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        tstamp, value = value
+        if not self.keys_changed and key not in self:
+            self.keys_changed = True
+        self._pending[key] = [tstamp, value]
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._pending[key] = None
+        self.changed.add(key)
+        self.keys_changed = True
+
+    def __contains__(self, key):
+        if key in self._pending:
+            return self._pending[key] is not None
+        for _ in self._query('SELECT 1 FROM items WHERE key = ?', (key,)):
+            return True
+        return False
+
+    def _with_pending(self, keys, prefix=''):
+        # the stored `keys` with the pending changes applied
+        pending = self._pending
+        keys = [k for k in keys if k not in pending]
+        keys.extend(k for k, v in pending.items()
+                    if v is not None and k.startswith(prefix))
+        return keys
+
+    def __iter__(self):
+        keys = [k for k, in self._query('SELECT key FROM items')]
+        if self._pending:
+            keys = self._with_pending(keys)
+        return iter(keys)
+
+    def __len__(self):
+        if self._pending:
+            return len(list(iter(self)))
+        for n, in self._query('SELECT count(*) FROM items'):
+            return n
+        return 0
+
+    def prefix_keys(self, prefix):
+        """Return the sorted keys starting with `prefix`."""
+        if not prefix:
+            keys = [k for k, in self._query(
+                'SELECT key FROM items ORDER BY key')]
+        else:
+            # a range of the primary key, up to the next possible prefix
+            end = prefix[:-1] + chr(min(ord(prefix[-1]) + 1, 0x10ffff))
+            keys = [k for k, in self._query(
+                'SELECT key FROM items WHERE key >= ? AND key < ? '
+                'ORDER BY key', (prefix, end)) if k.startswith(prefix)]
+        if self._pending:
+            keys = sorted(self._with_pending(keys, prefix))
+        return keys
+
+    def items(self):
+        """Return the items in timestamp order."""
+        items = [(k, [t, _unpack_value(v)]) for k, t, v in self._query(
+            'SELECT key, tstamp, value FROM items ORDER BY tstamp, key')]
+        if self._pending:
+            items = [kv for kv in items if kv[0] not in self._pending]
+            items.extend((k, list(v)) for k, v in self._pending.items()
+                         if v is not None)
+            items.sort(key=lambda kv: (kv[1][0], kv[0]))
+        return items
+
+    def latest(self, count=None, before=None):
+        """Return the newest (timestamp, key, value), newest first.
+
+        The rows are read backwards from the timestamp index, and only
+        `count` of them are read.
+        """
+        if self._pending:
+            return _latest(self.items(), count, before)
+        sql = 'SELECT tstamp, key, value FROM items'
+        args = []
+        if before is not None:
+            sql += ' WHERE tstamp < ?'
+            args.append(before)
+        sql += ' ORDER BY tstamp DESC, key DESC'
+        if count is not None:
+            sql += ' LIMIT ?'
+            args.append(count)
+        return [(t, k, _unpack_value(v))
+                for t, k, v in self._query(sql, args)]
+
+    def update(self, d):
+        self._pending.update((k, [t, v]) for k, (t, v) in d.items())
+        self.changed.update(d)
+        self.keys_changed = True
+
+    def clear(self):
+        for k in list(self):
+            self._pending[k] = None
+            self.changed.add(k)
+        self.keys_changed = True
+
+    def changes(self):
+        """Return the changed items and the deleted keys."""
+        updates = {k: list(v) for k, v in self._pending.items()
+                   if v is not None}
+        deleted = [k for k, v in self._pending.items() if v is None]
+        return updates, deleted
+
+    def rollback(self):
+        """Discard the changes that were not flushed."""
+        self._pending.clear()
+        self.changed.clear()
+        self.keys_changed = False
+
+    def _insert_log(self, db, records):
+        import json
+        db.executemany(
+            'INSERT INTO log (tstamp, record) VALUES (?, ?)',
+            ((rec[0], json.dumps(rec)) for rec in records))
+
+    def flush(self, log=()):
+        """Write the changes and the `log` records in one transaction."""
+        if _profile is not None:
+            t0 = _profile.clock()
+        index = None
+        if not self.keys_changed:
+            index = _read_key_index(self.index_file, self.signature())
+        pending = self._pending
+        db = self._conn(create=True)
+        with db:  # commits, or rolls back on an error
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany(
+                'INSERT OR REPLACE INTO items (key, tstamp, value) '
+                'VALUES (?, ?, ?)',
+                ((k, v[0], _pack_value(v[1], self.value_min))
+                 for k, v in pending.items() if v is not None))
+            db.executemany(
+                'DELETE FROM items WHERE key = ?',
+                ((k,) for k, v in pending.items() if v is None))
+            self._insert_log(db, log)
+        if _profile is not None:
+            _profile.add('commit', t0)
+        self.rollback()  # the changes are stored
+
+        # the primary key keeps the keys sorted
+        sig = self.signature()
+        if index is None:
+            keys = [k for k, in self._query(
+                'SELECT key FROM items ORDER BY key')]
+            _write_key_index(self.index_file, sig, keys)
+        else:
+            _write_key_index(self.index_file, sig, body=index)
+
+    def next_counter(self, prefix, start):
+        """Increment and return the counter of `prefix`.
+
+        The counter is committed at once, in its own transaction, as the
+        counters file of the JSON backend is. A missing counter starts
+        from `start()`, the highest number in use.
+        """
+        db = self._conn(create=True)
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            for num, in db.execute(
+                    'SELECT value FROM counters WHERE prefix = ?', (prefix,)):
+                break
+            else:
+                num = start()
+            db.execute('INSERT OR REPLACE INTO counters (prefix, value) '
+                       'VALUES (?, ?)', (prefix, num + 1))
+        return num + 1
+
+    def stored_values(self):
+        """Return the values as stored in the database, maybe compressed."""
+        return [v for v, in self._query('SELECT value FROM items')]
+
+    def append_log(self, records):
+        db = self._conn(create=True)
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            self._insert_log(db, records)
+
+    def iter_log(self, since=None):
+        import json
+        if since is None:
+            rows = self._query('SELECT record FROM log ORDER BY id')
+        else:
+            rows = self._query(
+                'SELECT record FROM log WHERE tstamp >= ? ORDER BY id',
+                (since,))
+        for rec, in rows:
+            yield json.loads(rec)
+
+    def tail_log(self, count):
+        import json
+        rows = list(self._query(
+            'SELECT record FROM log ORDER BY id DESC LIMIT ?', (count,)))
+        return [json.loads(rec) for rec, in reversed(rows)]
+
+    def remove(self):
+        self.close()
+        for f in (self.path, self.path + '-wal', self.path + '-shm',
+                  self.index_file):
+            if os.path.exists(f):
+                os.remove(f)
+
+
+_BACKENDS = collections.OrderedDict([
+    ('json', JsonBackend),
+    ('sqlite', SqliteBackend),
+    ])
+
+
+def _open_backend(ctx, name, environ):
+    """Return the backend holding a context, or the default for a new one.
+
+    The default backend is set by the CTX_BACKEND environment variable.
+    """
+    for cls in _BACKENDS.values():
+        backend = cls(ctx, name, environ)
+        if backend.exists():
+            return backend
+    default = environ.get('CTX_BACKEND') or 'json'
+    return _BACKENDS[default](ctx, name, environ)
+
+
+def _merged(cdict):
+    # a plain dictionary of a chain, using each map's own items()
+    d = {}
+    for m in reversed(cdict.maps):
+        d.update(m.items())
+    return d
+
+
+def _latest(items, count=None, before=None):
+    """Return the newest (timestamp, key, value) of `items`, newest first.
+
+    Only the items set before the timestamp `before` are included. With
+    a `count`, a heap keeps the newest ones instead of sorting them all.
+    """
+    import heapq
+    rows = ((v[0], k, v[1]) for k, v in items)
+    if before is not None:
+        rows = (r for r in rows if r[0] < before)
+    if count is None:
+        return sorted(rows, reverse=True)
+    return heapq.nlargest(count, rows)
+
+
+def _merged_view(cdict, ctx, chain_names):
+    """Return the merged dictionary of a chain for a full listing.
+
+    For chained contexts, the merged dictionary is cached under
+    `_cache/` and reused until one of the chained files changes.
+    """
+    if len(cdict.maps) == 1:
+        return cdict.maps[0]
+    if any(m.changed for m in cdict.maps):
+        return _merged(cdict)
+
+    sigs = [m.signature() for m in cdict.maps]
+    cache_file = os.path.join(ctx, '_cache',
+                              '+'.join(chain_names) + '.merged')
+    d = _read_cache(cache_file, sigs)
+    if d is None:
+        d = _merged(cdict)
+        _write_cache(cache_file, sigs, d)
+    return d
+
+
+class _Staged(collections.abc.MutableMapping):
+    """The staged changes of a transaction, layered over a backend.
+
+    Keys that are neither staged nor deleted are read from the backend,
+    which is only written by `flush()`, when the transaction is
+    committed. Other attributes are those of the backend.
+    """
+
+    def __init__(self, backend, staged=(), deleted=()):
+        self.backend = backend
+        self.staged = {k: list(v) for k, v in dict(staged).items()}
+        self.deleted = set(deleted) - self.staged.keys()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    @property
+    def changed(self):
+        return self.staged.keys() | self.deleted
+
+    def __getitem__(self, key):
+        if key in self.staged:
+            return self.staged[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.backend[key]
+
+    def __setitem__(self, key, value):
+        self.staged[key] = list(value)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.staged.pop(key, None)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.staged:
+            return True
+        return key not in self.deleted and key in self.backend
+
+    def __iter__(self):
+        hidden = self.changed
+        keys = [k for k in self.backend if k not in hidden]
+        keys.extend(self.staged)
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def prefix_keys(self, prefix):
+        """Return the sorted keys starting with `prefix`."""
+        hidden = self.changed
+        keys = [k for k in self.backend.prefix_keys(prefix)
+                if k not in hidden]
+        keys.extend(k for k in self.staged if k.startswith(prefix))
+        return sorted(keys)
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def latest(self, count=None, before=None):
+        """Return the newest (timestamp, key, value), newest first."""
+        if not self.changed:
+            return self.backend.latest(count, before)
+        return _latest(self.items(), count, before)
+
+    def clear(self):
+        self.deleted.update(self)
+        self.staged.clear()
+
+    def changes(self):
+        """Return the staged items and the deleted keys."""
+        return dict(self.staged), sorted(self.deleted)
+
+    def rollback(self):
+        """Discard the staged changes, the backend is left as it was."""
+        self.staged.clear()
+        self.deleted.clear()
+        self.backend.rollback()
+
+    def apply(self):
+        """Make the staged changes in the backend, without storing them."""
+        if self.staged:
+            self.backend.update(self.staged)
+        for k in self.deleted:
+            self.backend.pop(k, None)
+        self.staged.clear()
+        self.deleted.clear()
+
+    def flush(self, log=()):
+        """Write the staged changes to the backend and store them."""
+        self.apply()
+        self.backend.flush(log)
+
+
+class Context(collections.abc.MutableMapping):
+    """A context loaded once, for many reads and changes in one process.
+
+        from shellctx.ctx import Context
+
+        with Context() as c:            # the active context
+            c['key'] = 'value'          # same as `ctx set key value`
+            c.update({'a': '1', 'b': '2'})
+            print(c['key'], c.keys())
+
+    Keys map to their values. Files are read on first access, and the
+    changes are kept in memory with their log records until `flush()`,
+    which the `with` block calls on success. With `autoflush=True`, the
+    changes are also flushed when the interpreter exits.
+
+    `name` may chain contexts as in CTX_NAME, e.g. 'dev+main'. Lookups
+    fall through the chain and changes go to the first context.
+    """
+
+    def __init__(self, name=None, home=None, environ=None, autoflush=False):
+        if environ is None:
+            environ = os.environ
+        self.home = home or _ctx_home(environ)
+        if name is None:
+            name = environ.get('CTX_NAME') or _read_name(self.home)
+        self.chain_names = [i.strip() for i in name.split('+')]
+        self.name = self.chain_names[0]
+
+        # backends read their files on first access
+        maps = [_open_backend(self.home, cname, environ)
+                for cname in self.chain_names]
+        self.backend = maps[0]
+        self.cdict = collections.ChainMap(*maps)
+        self._log = []  # iterables of log records, not yet flushed
+
+        if autoflush:
+            import atexit
+            atexit.register(self.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+
+    def __getitem__(self, key):
+        return self.cdict[key][1]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def __contains__(self, key):
+        return key in self.cdict
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.merged())
+
+    @property
+    def dirty(self):
+        """True if there are changes that are not flushed."""
+        return bool(self._log)
+
+    def entry(self, key):
+        """Return the (timestamp, value) of a key."""
+        return tuple(self.cdict[key])
+
+    def merged(self):
+        """Return the merged dictionary of key: (timestamp, value)."""
+        # lower chained contexts are only read for full listings
+        return _merged_view(self.cdict, self.home, self.chain_names)
+
+    def keys(self):
+        """Return the sorted keys."""
+        return sorted(self.merged().keys())
+
+    def match_keys(self, prefix=None, glob=None, regex=None):
+        """Return the sorted keys with a prefix, or matching a pattern.
+
+        `glob` is matched against the whole key, and the regular
+        expression `regex` anywhere in it. The keys are looked up in the
+        key index of each context, starting at the literal prefix of the
+        pattern, so a scan only reads the keys that may match.
+        """
+        import heapq
+        tests = []
+        scan = prefix or ''
+        if glob is not None:
+            import fnmatch
+            tests.append(lambda k: fnmatch.fnmatchcase(k, glob))
+            if not scan:
+                scan = _pattern_prefix(glob, '*?[')
+        if regex is not None:
+            import re
+            tests.append(re.compile(regex).search)
+            if not scan and regex.startswith('^') and '|' not in regex:
+                scan = _pattern_prefix(
+                    regex[1:], '.^$*+?{}[]\\|()', '*?{')
+
+        keys = []
+        found = [m.prefix_keys(scan) for m in self.cdict.maps]
+        for k in heapq.merge(*found):
+            if keys and keys[-1] == k:
+                continue  # in more than one chained context
+            if all(test(k) for test in tests):
+                keys.append(k)
+        return keys
+
+    def items(self):
+        """Return the (key, value) pairs in the order they were set."""
+        everything = sorted(
+            (v[0], k, v[1]) for k, v in self.merged().items())
+        return [(k, v) for t, k, v in everything]
+
+    def latest(self, limit=None, offset=0, before=None):
+        """Return the newest (timestamp, key, value), newest first.
+
+        `offset` skips the newest ones, `limit` caps their number and
+        `before` only includes the items set before that timestamp.
+        """
+        count = None if limit is None else offset + limit
+        m = self.merged()
+        if hasattr(m, 'latest'):
+            rows = m.latest(count, before)
+        else:
+            rows = _latest(m.items(), count, before)
+        return rows[offset:]
+
+    def set(self, key, value, now=None):
+        if now is None:
+            now = get_now()
+        self.cdict[key] = (now, value)
+        self.record([(now, 'set', key, value)])
+
+    def delete(self, *keys, now=None):
+        """Delete keys from the first context, all or none of them."""
+        keys = list(collections.OrderedDict.fromkeys(keys))
+        for k in keys:
+            if k not in self.backend:
+                raise KeyError(
+                    'Key not found in the first mapping: {!r}'.format(k))
+        for k in keys:
+            del self.backend[k]
+        if now is None:
+            now = get_now()
+        self.record([(now, 'del', keys[0], ' '.join(keys[1:]) or None)])
+
+    def update(self, items, now=None, source=None):
+        """Set many keys from a mapping or an iterable of (key, value).
+
+        The keys get timestamps one microsecond apart, in input order.
+        `source` names the input in the log.
+        """
+        if now is None:
+            now = get_now()
+        if hasattr(items, 'items'):
+            items = items.items()
+        d = {}
+        for (k, v), now2 in zip(items, _unique_times(now)):
+            d[k] = (now2, v)
+        # update if no error occurs
+        self.backend.update(d)
+        self.record([(now, 'update', source, None)])
+        self.record((v[0], 'update_set', k, v[1]) for k, v in d.items())
+
+    def record(self, records):
+        """Add log records for changes made directly on `cdict`."""
+        self._log.append(records)
+
+    def pending(self):
+        """Return an iterator of the log records that are not flushed."""
+        import itertools
+        return itertools.chain.from_iterable(self._log)
+
+    def flush(self):
+        """Store the changes and append their records to the log."""
+        if self._log:
+            self.backend.flush(self.pending())
+            self._log = []
+
+    def rollback(self):
+        """Discard the changes that are not flushed."""
+        try:
+            self.backend.rollback()
+            self._log = []
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the database connections and mapped files.
+
+        They are opened again on the next access.
+        """
+        for m in self.cdict.maps:
+            m.close()
+
+
 class State:
     # FIXME: Limit the possible keywords
     def __init__(self, **kw):
@@ -56,8 +1762,7 @@ class TinyClick:
     def dispatch(self, state):
         for k, (func, doc, long_doc) in self.commands.items():
             if state.cmd in k:
-                func(state)
-                return 0
+                return func(state) or 0
 
     def _register(self, func, cmd, doc, long_doc):
         if isinstance(cmd, str):
@@ -81,10 +1786,33 @@ tclick = TinyClick()
 reg = tclick.reg
 
 
-@reg('log',  """Show the edit log of the current context""")
+@reg('log',  """Show the edit log of the current context""",
+     """log [--tail N] [--since TIMESTAMP]""")
 def log(ctx):
-    log = ctx.load_log()
-    for x in log:
+    tail = None
+    since = None
+    args = list(ctx.argv[2:])
+    while args:
+        opt = args.pop(0)
+        try:
+            if opt == '--tail':
+                tail = int(args.pop(0))
+            elif opt == '--since':
+                since = args.pop(0)
+            else:
+                raise ValueError(opt)
+        except (IndexError, ValueError):
+            print('invalid log option: %r' % opt, file=ctx.stderr)
+            return 1
+
+    if tail is None:
+        records = ctx.iter_log(since)
+    elif since is None:
+        records = ctx.tail_log(tail)
+    else:
+        records = collections.deque(ctx.iter_log(since), maxlen=tail)
+
+    for x in records:
         print(x, file=ctx.stdout)
 
 
@@ -93,30 +1821,469 @@ def help(ctx):
     handler.help()
 
 
-@reg('waitpid', "Wait for a PID to finish")
-def waitpid(ctx):
+def _pid_exited(pid):
+    # poll a process for its exit, reaping it if it is a child of ours
     try:
-        pid = int(ctx.key)
-    except:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return True
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # running as another user
+    return False
+
+
+def _wait_pids(pids, wait_all=True, timeout=None, report=None,
+               interval=0.1):
+    """Wait for processes to exit, without starting any other process.
+
+    On Linux, each PID is opened as a pidfd and all of them are waited on
+    with one selector. Where pidfds are not available, the PIDs are polled
+    every `interval` seconds. `report(pid)` is called as each one exits.
+
+    Returns the PIDs still running: none, unless `timeout` seconds passed
+    first, or `wait_all` is false and one of them exited.
+    """
+    import time
+    import selectors
+    deadline = None if timeout is None else time.monotonic() + timeout
+    running = collections.OrderedDict.fromkeys(pids)
+    total = len(running)
+    sel = selectors.DefaultSelector()
+    polled = []
+    exited = []
+
+    for pid in running:
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            exited.append(pid)
+        except (AttributeError, OSError):
+            polled.append(pid)
+        else:
+            sel.register(fd, selectors.EVENT_READ, pid)
+
+    try:
+        while True:
+            exited.extend(pid for pid in polled if _pid_exited(pid))
+            for pid in exited:
+                if pid in polled:
+                    polled.remove(pid)
+                del running[pid]
+                if report is not None:
+                    report(pid)
+            exited = []
+
+            if not running or (not wait_all and len(running) < total):
+                break
+
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+            if polled:
+                wait = interval if wait is None else min(wait, interval)
+
+            if not sel.get_map():
+                time.sleep(wait)
+                continue
+            for key, events in sel.select(wait):
+                sel.unregister(key.fd)
+                os.close(key.fd)
+                _pid_exited(key.data)  # reap our own children
+                exited.append(key.data)
+    finally:
+        for key in list(sel.get_map().values()):
+            os.close(key.fd)
+        sel.close()
+
+    return list(running)
+
+
+@reg('waitpid', "Wait for PIDs to finish",
+     """waitpid [--any|--all] [--timeout SEC] PID [message]
+       waitpid [--any|--all] [--timeout SEC] PID... -- [message]""")
+def waitpid(ctx):
+    # waits for all the PIDs by default, or the first one with --any,
+    # and reports each exit as it happens
+    import time
+    wait_all = True
+    timeout = None
+    pids = []
+    args = list(ctx.argv[2:])
+    # several PIDs end at `--`, otherwise the message follows the PID,
+    # even if it starts with a number
+    several = '--' in args
+    while args:
+        opt = args[0]
+        try:
+            if opt == '--any':
+                wait_all = False
+            elif opt == '--all':
+                wait_all = True
+            elif opt == '--timeout':
+                args.pop(0)
+                timeout = float(args[0])
+            elif opt == '--' and several:
+                args.pop(0)
+                break
+            elif opt.isdigit() and (several or not pids):
+                pids.append(int(opt))
+            else:
+                break  # the message
+        except (IndexError, ValueError):
+            print('invalid waitpid option: %r' % opt, file=ctx.stderr)
+            return 1
+        args.pop(0)
+
+    if not pids:
         print('invalid PID: %r' % ctx.key, file=ctx.stderr)
         return 1
+    pids = list(collections.OrderedDict.fromkeys(pids))
+    if sys.platform.startswith('win'):
+        print('waitpid is not supported on Windows', file=ctx.stderr)
+        return 1
+
+    for pid in pids:
+        if _pid_exited(pid):
+            print("PID not found: %i" % pid, file=ctx.stderr)
+            return 1
 
-    ret = os.system('tail /dev/null')
-    if ret != 0:
-        print("unable to run 'tail /dev/null'", file=ctx.stderr)
+    t0 = time.monotonic()
+
+    def report(pid):
+        print('PID %i finished after %.1f s' % (pid, time.monotonic() - t0),
+              file=ctx.stdout, flush=True)
+
+    running = _wait_pids(pids, wait_all, timeout, report)
+    if len(running) == len(pids) or (wait_all and running):
+        print('timeout, still running: %s' % ' '.join(map(str, running)),
+              file=ctx.stderr)
+        return 124
+
+    if args:
+        _do_message_box(ctx, "waitpid %s finished\n%s" % (
+            ' '.join(map(str, pids)), ' '.join(args)))
+
+
+def _map_job(argv):
+    # run one job of `map`, capturing its output
+    import subprocess
+    try:
+        proc = subprocess.run(argv, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as exc:
+        return 127, b'', ('%s\n' % exc).encode('utf8')
+    return proc.returncode, proc.stdout, proc.stderr
+
+
+@reg('map', "Run a stored command once for each line of arguments",
+     """map KEY [-j N] [--ordered] [FILE|-]""")
+def map_key(ctx):
+    # each line of the file, - for stdin, holds shell-quoted arguments
+    # that are added to the command of KEY, as with `exec`
+    #   ctx map ping -j 16 hosts.txt
+    # the output of each job is printed when it finishes, or in input
+    # order with --ordered, and the exit status is the number of failed
+    # jobs, up to 100
+    import shlex
+    import concurrent.futures as cf
+
+    jobs = os.cpu_count() or 1
+    ordered = False
+    source = '-'
+    args = list(ctx.argv[3:])
+    while args:
+        opt = args.pop(0)
+        try:
+            if opt == '-j':
+                jobs = int(args.pop(0))
+                if jobs < 1:
+                    raise ValueError(jobs)
+            elif opt == '--ordered':
+                ordered = True
+            elif opt.startswith('-') and opt != '-':
+                raise ValueError(opt)
+            else:
+                source = opt
+        except (IndexError, ValueError):
+            print('invalid map option: %r' % opt, file=ctx.stderr)
+            return 1
+
+    cmd = shlex.split(ctx.cdict[ctx.key][1])
+    fid = sys.stdin if source == '-' else open(source, 'r')
+
+    failed = []
+    done = {}  # finished jobs waiting for their turn, when ordered
+    next_job = 0
+
+    def show(n, line, result):
+        status, out, err = result
+        ctx.stdout.write(out.decode('utf8', 'replace'))
+        ctx.stdout.flush()
+        ctx.stderr.write(err.decode('utf8', 'replace'))
+        if status:
+            failed.append((n, status, line))
+
+    def finish(futures):
+        nonlocal next_job
+        for fut in futures:
+            n, line = running.pop(fut)
+            if not ordered:
+                show(n, line, fut.result())
+                continue
+            done[n] = (line, fut.result())
+            while next_job in done:
+                show(next_job, *done.pop(next_job))
+                next_job += 1
+
+    running = {}
+    with fid, cf.ThreadPoolExecutor(jobs) as pool:
+        n = 0
+        for line in fid:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            if len(running) >= jobs:
+                finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+                finish(finished)
+            fut = pool.submit(_map_job, cmd + shlex.split(line))
+            running[fut] = (n, line)
+            n += 1
+        finish(cf.as_completed(list(running)))
+
+    if failed:
+        print('map: %i of %i jobs failed' % (len(failed), n), file=ctx.stderr)
+        for n, status, line in sorted(failed):
+            print('  exit status %i: %s' % (status, line), file=ctx.stderr)
+        return min(len(failed), 100)
+
+
+def _run_plan(cdict, target):
+    """Return the steps of `target` in dependency order, and their deps.
+
+    The dependencies of a key are the keys listed in `_dep_<key>`. A key
+    with dependencies but no command of its own groups its dependencies.
+    """
+    order = []
+    deps = {}
+    visiting = []
+
+    def visit(key):
+        if key in deps:
+            return
+        if key in visiting:
+            cycle = visiting[visiting.index(key):] + [key]
+            raise ValueError('dependency cycle: %s' % ' -> '.join(cycle))
+        dep = cdict.get('_dep_' + key)
+        names = dep[1].split() if dep else []
+        if key not in cdict and not names:
+            raise KeyError(key)
+        visiting.append(key)
+        for name in names:
+            visit(name)
+        visiting.pop()
+        deps[key] = names
+        order.append(key)
+
+    visit(target)
+    return order, deps
+
+
+def _run_stamp(cdict, key, dep_stamps):
+    # identify the command of a step, its input files listed in
+    # `_in_<key>`, and the stamps of its dependencies
+    import json
+    import shlex
+    import hashlib
+    cmd = cdict[key][1] if key in cdict else None
+    inputs = cdict.get('_in_' + key)
+    paths = shlex.split(inputs[1]) if inputs else []
+    state = [cmd, [(p, _file_sig(p)) for p in paths], dep_stamps]
+    return hashlib.sha256(json.dumps(state).encode('utf8')).hexdigest()
+
+
+def _run_step(cmd):
+    import subprocess
+    return subprocess.run(cmd, shell=True).returncode
+
+
+@reg(('run', 'dryrun'), "Run a stored command after its dependencies",
+     """run|dryrun TARGET [-j N] [--force]""")
+def run_target(ctx):
+    # runs the shell commands of the keys TARGET depends on, then its own
+    #   ctx set _dep_test "build lint"     test needs build and lint
+    #   ctx set _in_build "main.c util.c"  build reads these files
+    # independent steps run at once, up to -j N. A step is skipped if its
+    # command, input files and dependencies are unchanged since it last
+    # succeeded, unless --force is given. dryrun prints the schedule.
+    import json
+    import concurrent.futures as cf
+
+    jobs = os.cpu_count() or 1
+    force = False
+    args = list(ctx.argv[3:])
+    while args:
+        opt = args.pop(0)
+        try:
+            if opt == '-j':
+                jobs = int(args.pop(0))
+                if jobs < 1:
+                    raise ValueError(jobs)
+            elif opt == '--force':
+                force = True
+            else:
+                raise ValueError(opt)
+        except (IndexError, ValueError):
+            print('invalid run option: %r' % opt, file=ctx.stderr)
+            return 1
+
+    cdict = ctx.cdict
+    order, deps = _run_plan(cdict, ctx.key)
+
+    stamps_file = os.path.join(ctx.ctx, '_run', ctx.name + '.json')
+    try:
+        with open(stamps_file, 'rb') as fid:
+            stamps = json.loads(fid.read().decode('utf8'))
+    except FileNotFoundError:
+        stamps = {}
+
+    # a step runs if it changed, or if one of its dependencies runs
+    stamp = {}
+    todo = collections.OrderedDict()
+    for key in order:
+        stamp[key] = _run_stamp(cdict, key, [stamp[d] for d in deps[key]])
+        if (force or stamps.get(key) != stamp[key]
+                or any(d in todo for d in deps[key])):
+            todo[key] = 1 + max([todo[d] for d in deps[key] if d in todo],
+                                default=0)
+
+    def command(key):
+        return cdict[key][1] if key in cdict else None
+
+    if ctx.cmd == 'dryrun':
+        for key in order:
+            if key not in todo:
+                print('up to date: %s' % key, file=ctx.stdout)
+        for key, wave in sorted(todo.items(), key=lambda kv: kv[1]):
+            print('dryrun wave %i: %s: %s' % (wave, key, command(key) or ''),
+                  file=ctx.stdout)
+        return
+
+    def succeeded(key):
+        done.add(key)
+        stamps[key] = stamp[key]
+        os.makedirs(os.path.dirname(stamps_file), exist_ok=True)
+        _atomic_write(stamps_file, json.dumps(stamps).encode('utf8'))
+
+    done = set(key for key in order if key not in todo)
+    pending = list(todo)
+    running = {}
+    failed = []
+    with cf.ThreadPoolExecutor(jobs) as pool:
+        while True:
+            ready = [key for key in pending
+                     if all(d in done for d in deps[key])]
+            while ready and not failed and len(running) < jobs:
+                key = ready.pop(0)
+                pending.remove(key)
+                if command(key) is None:
+                    succeeded(key)
+                    ready = [key for key in pending
+                             if all(d in done for d in deps[key])]
+                    continue
+                print('run %s: %s' % (key, command(key)), file=ctx.stderr)
+                running[pool.submit(_run_step, command(key))] = key
+
+            if not running:
+                break
+            finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for fut in finished:
+                key = running.pop(fut)
+                status = fut.result()
+                if status:
+                    print('run %s failed: exit status %i' % (key, status),
+                          file=ctx.stderr)
+                    failed.append(key)
+                else:
+                    succeeded(key)
+
+    if failed:
         return 1
 
-    if not os.path.isdir('/proc/%i' % pid):
-        print("PID not found: %i" % pid, file=ctx.stderr)
+
+@reg('migrate', "Move the current context to another storage backend",
+     """migrate %s""" % '|'.join(_BACKENDS))
+def migrate(ctx):
+    cls = _BACKENDS.get(ctx.key)
+    if cls is None:
+        print('unknown backend: %r' % ctx.key, file=ctx.stderr)
         return 1
 
-    shell = "tail -f --pid %i /dev/null" % pid
-    ret = os.system(shell)
+    src = ctx._cdict
+    if isinstance(src, cls):
+        print('context "%s" already uses %s' % (ctx.name, ctx.key),
+              file=ctx.stdout)
+        return 0
+
+    dst = cls(ctx.ctx, ctx.name, ctx.environ)
+    for k, v in src.items():
+        dst[k] = v
+    log = list(src.iter_log())
+    log.append((ctx.now, ctx.cmd, ctx.key, None))
+    dst.flush(log)
+    src.remove()
+    dst.flush()  # rewrite the key index, which shares the removed name
 
-    if ctx.value is not None:
-        _do_message_box(ctx, "waitpid %i finished\n%s" % (pid, ctx.value))
+    print('migrated context "%s" to %s' % (ctx.name, ctx.key),
+          file=ctx.stdout)
 
-    return ret
+
+def _size_stats(path):
+    # the size of a file, and its size decompressed if it is gzip
+    try:
+        with open(path, 'rb') as fid:
+            if fid.read(2) != _GZIP_MAGIC:
+                size = fid.seek(0, os.SEEK_END)
+                return size, size
+            fid.seek(0)
+            data = fid.read()
+    except OSError:
+        return None
+    return len(data), len(_gunzip(data))
+
+
+@reg('stats', "Show the storage sizes and compression of the context")
+def stats(ctx):
+    backend = ctx._cdict
+    kind = [k for k, cls in _BACKENDS.items() if isinstance(backend, cls)]
+    print('context "%s" (%s): %i keys' % (ctx.name, kind[0], len(backend)),
+          file=ctx.stdout)
+    level, value_min = _compress_options(ctx.environ)
+    print('  CTX_COMPRESS=%i CTX_COMPRESS_MIN=%s' % (level, value_min),
+          file=ctx.stdout)
+
+    def line(label, stored, raw):
+        ratio = raw / stored if stored else 1.0
+        print('  %-20s %12i bytes %12i uncompressed  x%.2f' % (
+            label, stored, raw, ratio), file=ctx.stdout)
+
+    for path in collections.OrderedDict.fromkeys(
+            [backend.path, backend.log_file]):
+        sizes = _size_stats(path)
+        if sizes is not None:
+            line(os.path.basename(path), *sizes)
+
+    packed = [v for v in backend.stored_values()
+              if isinstance(v, str) and v.startswith(_PACKED)]
+    line('%i packed values' % len(packed), sum(len(v) for v in packed),
+         sum(len(_unpack_value(v).encode('utf8', 'surrogatepass'))
+             for v in packed))
 
 
 def _do_message_box(ctx, msg):
@@ -182,8 +2349,151 @@ def mbox(ctx):
     _do_message_box(ctx, msg)
 
 
-def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
+# The commands of the `context()` elif chain, for shell completion,
+# which adds the commands registered with `tclick`.
+_COMMANDS = (
+    'args', 'setpath', 'get', 'shell', 'dryshell', 'exec', 'dryexec',
+    'execvp', 'set', 'del', 'keys', 'rename', 'copy', 'items', 'switch',
+    'import', 'update', 'txn', 'batch', 'clear', 'version', 'entry',
+    'dosvar', 'now', 'help', 'name',
+    )
+
+# commands taking a key as their first argument, or only keys
+_KEY_COMMANDS = ('get', 'set', 'setpath', 'exec', 'dryexec', 'execvp',
+                 'rename', 'copy', 'dosvar', 'map', 'run', 'dryrun')
+_KEYS_COMMANDS = ('del', 'items', 'shell', 'dryshell')
+
+# Completion reads the key index files, without starting Python.
+_COMPLETION = {}
+
+_COMPLETION['bash'] = r"""# bash completion for ctx, from `ctx _completion bash`
+#   eval "$(ctx _completion bash)"
+
+_ctx_keys() {
+    # keys of the active context chain starting with $1
+    local home="${CTX_HOME:-$HOME/.ctx}" name part
+    local -a files=()
+    name="${CTX_NAME:-$(cat "$home/_name.txt" 2>/dev/null)}"
+    local IFS='+'
+    for part in ${name:-main}; do
+        part="${part// /}"
+        [ -f "$home/$part.keys" ] && files+=("$home/$part.keys")
+    done
+    [ ${#files[@]} -gt 0 ] || return
+    P="$1" awk 'FNR > 1 && index($0, ENVIRON["P"]) == 1' "${files[@]}" |
+        sort -u
+}
+
+_ctx_contexts() {
+    local home="${CTX_HOME:-$HOME/.ctx}" f
+    for f in "$home"/*.json "$home"/*.sqlite; do
+        [ -e "$f" ] || continue
+        f="${f##*/}"
+        printf '%s\n' "${f%.*}"
+    done
+}
+
+_ctx() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" cmd="${COMP_WORDS[1]}"
+    COMPREPLY=()
+    if [ "$COMP_CWORD" -eq 1 ]; then
+        COMPREPLY=($(compgen -W "@COMMANDS@" -- "$cur"))
+        return
+    fi
+    local IFS=$'\n'
+    case "$cmd" in
+        switch)
+            [ "$COMP_CWORD" -eq 2 ] &&
+                COMPREPLY=($(compgen -W "$(_ctx_contexts)" -- "$cur")) ;;
+        @KEYS_COMMANDS@)
+            COMPREPLY=($(_ctx_keys "$cur")) ;;
+        @KEY_COMMANDS@)
+            [ "$COMP_CWORD" -eq 2 ] && COMPREPLY=($(_ctx_keys "$cur")) ;;
+    esac
+}
+
+complete -o default -F _ctx ctx
+"""
+
+_COMPLETION['zsh'] = r"""#compdef ctx
+# zsh completion for ctx, from `ctx _completion zsh`
+#   eval "$(ctx _completion zsh)", or save as _ctx in a directory on $fpath
+
+_ctx_keys() {
+    # keys of the active context chain starting with $1
+    local home=${CTX_HOME:-$HOME/.ctx} name part
+    local -a files
+    name=${CTX_NAME:-$(cat $home/_name.txt 2>/dev/null)}
+    for part in ${(s:+:)${name:-main}}; do
+        part=${part// /}
+        [[ -f $home/$part.keys ]] && files+=($home/$part.keys)
+    done
+    (( $#files )) || return
+    P=$1 awk 'FNR > 1 && index($0, ENVIRON["P"]) == 1' $files | sort -u
+}
+
+_ctx_contexts() {
+    local home=${CTX_HOME:-$HOME/.ctx}
+    print -rl -- $home/*.json(N:t:r) $home/*.sqlite(N:t:r)
+}
+
+_ctx() {
+    if (( CURRENT == 2 )); then
+        compadd -- @COMMANDS@
+        return
+    fi
+    case $words[2] in
+        switch)
+            (( CURRENT == 3 )) && compadd -- ${(f)"$(_ctx_contexts)"} ;;
+        @KEYS_COMMANDS@)
+            compadd -- ${(f)"$(_ctx_keys $PREFIX)"} ;;
+        @KEY_COMMANDS@)
+            if (( CURRENT == 3 )); then
+                compadd -- ${(f)"$(_ctx_keys $PREFIX)"}
+            else
+                _files
+            fi ;;
+        *)
+            _files ;;
+    esac
+}
+
+if [[ $zsh_eval_context[-1] == loadautofunc ]]; then
+    _ctx "$@"
+else
+    compdef _ctx ctx
+fi
+"""
+
+
+def _completion_script(shell):
+    names = set(_COMMANDS)
+    for cmds in tclick.commands:
+        names.update(cmds)
+    commands = sorted(n for n in names if not n.startswith(('_', '-')))
+    return (_COMPLETION[shell]
+            .replace('@COMMANDS@', ' '.join(commands))
+            .replace('@KEYS_COMMANDS@', '|'.join(_KEYS_COMMANDS))
+            .replace('@KEY_COMMANDS@', '|'.join(_KEY_COMMANDS)))
+
+
+@reg('_completion', "Print a shell completion script",
+     """_completion %s""" % '|'.join(_COMPLETION))
+def completion(ctx):
+    if ctx.key not in _COMPLETION:
+        print('unknown shell: %r' % ctx.key, file=ctx.stderr)
+        return 1
+    print(_completion_script(ctx.key), file=ctx.stdout, end='')
 
+
+def _ctx_home(environ):
+    ctx_home = environ.get('CTX_HOME', None)
+    if ctx_home is None:
+        return os.path.expanduser('~/.ctx')
+    return ctx_home
+
+
+def _colors(_color, _isatty):
     # ANSI coloring
     color = {
         '': '\033[0m',  # reset
@@ -194,12 +2504,13 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
         'yellow': '\033[0;33m',
     }
 
-    WINDOWS = False
     if sys.platform.startswith('win'):
-        WINDOWS = True
         color = dict.fromkeys(color.keys(), '')
 
-    if not sys.stdout.isatty() or not _color:
+    if _isatty is None:
+        _isatty = sys.stdout.isatty()
+
+    if not _isatty or not _color:
         color = dict.fromkeys(color.keys(), '')
 
     style = {
@@ -210,8 +2521,286 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
         'command': color['blue'],
         'context': color['blue'],
     }
+    return color, style
 
 
+def _read_name(ctx):
+    # grab the pointer name
+    if _profile is not None:
+        t0 = _profile.clock()
+    name = 'main'
+    name_file = os.path.join(ctx, '_name.txt')
+    if os.path.exists(name_file):
+        with open(name_file, 'r') as fid:
+            name = fid.read().strip()
+    if _profile is not None:
+        _profile.add('name', t0)
+    return name
+
+
+# Read-only commands answered by `_fast_context` before the full setup.
+_FAST_COMMANDS = ('get', 'name', 'keys')
+
+
+def _fast_context(argv, environ, stdout, _color, _isatty):
+    """Answer a simple read-only command with as little work as possible.
+
+    Only the files needed for the answer are read, and `keys` reads the
+    key indexes instead of the contexts. Returns None when the full
+    `context()` path is needed, e.g. for verbose output or a missing key,
+    so the output and errors stay the same.
+    """
+    cmd = argv[1]
+    nargs = 3 if cmd == 'get' else 2
+    if len(argv) != nargs or int(environ.get('CTX_VERBOSE', 0)):
+        return None
+    if environ.get('CTX_TXN'):
+        return None  # staged changes are applied by context()
+
+    c = Context(environ=environ)
+    try:
+        if cmd == 'get':
+            key = argv[2]
+            if key not in c:
+                return None
+            lines = [c[key]]
+            kind = 'value'
+
+        elif cmd == 'keys':
+            # read from the key indexes, not the context files
+            lines = c.match_keys()
+            kind = 'key'
+
+        else:
+            lines = ['+'.join(c.chain_names)]
+            kind = 'context'
+    finally:
+        c.close()
+
+    color, style = _colors(_color, _isatty)
+    for line in lines:
+        s = (style[kind],
+             line,
+             color[''],
+             )
+        print(''.join(s), file=stdout)
+    return 0
+
+
+def _is_exe(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def _resolve_exec(name, ctx, environ):
+    """Return the path of an executable, searched on PATH like execvp.
+
+    Paths found on PATH are cached in `_cache/execpath.json` along with
+    the PATH they were found on, and reused while PATH is the same and
+    the file is still executable.
+    """
+    if os.path.dirname(name):
+        return name
+    import json
+    path_env = environ.get('PATH', os.defpath)
+    cache_file = os.path.join(ctx, '_cache', 'execpath.json')
+    try:
+        with open(cache_file, 'rb') as fid:
+            cache = json.loads(fid.read().decode('utf8'))
+    except (OSError, ValueError):
+        cache = {}
+    hit = cache.get(name)
+    if hit and hit[1] == path_env and _is_exe(hit[0]):
+        return hit[0]
+
+    for d in path_env.split(os.pathsep):
+        path = os.path.join(d or os.curdir, name)
+        if _is_exe(path):
+            if os.path.isabs(path):
+                # relative PATH entries depend on the working directory
+                cache[name] = [path, path_env]
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                _atomic_write(cache_file, json.dumps(cache).encode('utf8'))
+            return path
+    return None
+
+
+def _read_batch(fid, null=False):
+    # yield the argv of each command, one per line, or as NUL-terminated
+    # arguments with an empty argument ending each command
+    import shlex
+    if not null:
+        for line in fid:
+            args = shlex.split(line, comments=True)
+            if args:
+                yield args
+        return
+
+    args = []
+    for arg in fid.read().split('\0'):
+        if arg:
+            args.append(arg)
+        elif args:
+            yield args
+            args = []
+    if args:
+        yield args
+
+
+def _load_txn(txn_file, name):
+    # the staged changes of an open transaction on context `name`
+    import json
+    try:
+        with open(txn_file, 'rb') as fid:
+            txn = json.loads(fid.read().decode('utf8'))
+    except FileNotFoundError:
+        raise ValueError('no transaction %s' % os.path.basename(
+            txn_file).rpartition('.')[0]) from None
+    if txn['name'] != name:
+        raise ValueError('transaction is for context "%s"' % txn['name'])
+    return txn
+
+
+def _save_txn(txn_file, txn):
+    import json
+    _atomic_write(txn_file, json.dumps(txn).encode('utf8'))
+
+
+# options of `items` and `_fullitems` for the newest items
+_PAGE_OPTIONS = ('--limit', '--offset', '--before')
+
+
+def _page_options(args):
+    """Parse `--limit N`, `--offset N` and `--before TIMESTAMP`."""
+    page = {}
+    args = list(args)
+    while args:
+        opt = args.pop(0)
+        if opt not in _PAGE_OPTIONS or not args:
+            raise ValueError('invalid option: %r' % opt)
+        arg = args.pop(0)
+        if opt != '--before':
+            arg = int(arg)
+            if arg < 0:
+                raise ValueError('%s must not be negative' % opt)
+        page[opt[2:]] = arg
+    return page
+
+
+# machine-readable output of `keys`, `items` and `_fullitems`
+_FORMATS = ('json', 'jsonl', 'nul', 'tsv')
+
+
+def _write_rows(stdout, fmt, rows, chunk=10000):
+    """Write rows of fields in one of the `_FORMATS`.
+
+    json is an array of the rows and jsonl has a row per line, with the
+    rows of a single field, i.e. keys, as plain strings. nul ends every
+    field with a NUL, and tsv escapes backslash, tab, newline and carriage
+    return. The records are joined and written `chunk` rows at a time.
+    """
+    import re
+    import itertools
+    from json.encoder import encode_basestring_ascii as enc
+    if fmt == 'tsv':
+        escape = str.maketrans({'\\': '\\\\', '\t': '\\t',
+                                '\n': '\\n', '\r': '\\r'})
+        special = re.compile('[\\\\\n\r]').search
+
+        def record(row):
+            # escape only the rows with special characters
+            line = '\t'.join(row)
+            if line.count('\t') >= len(row) or special(line):
+                line = '\t'.join([f.translate(escape) for f in row])
+            return line + '\n'
+    elif fmt == 'nul':
+        def record(row):
+            return '\0'.join(row) + '\0'
+    elif fmt in ('json', 'jsonl'):
+        def record(row):
+            if len(row) == 1:
+                return enc(row[0])
+            return '[%s]' % ', '.join([enc(f) for f in row])
+    else:
+        raise ValueError('unknown format: %r' % fmt)
+
+    rows = iter(rows)
+    sep = '\n' if fmt == 'jsonl' else ''
+    first = True
+    while True:
+        records = [record(row) for row in itertools.islice(rows, chunk)]
+        if not records:
+            break
+        if fmt == 'json':
+            stdout.write(('[\n' if first else ',\n') + ',\n'.join(records))
+        else:
+            stdout.write(sep.join(records) + sep)
+        first = False
+    if fmt == 'json':
+        stdout.write('[]\n' if first else '\n]\n')
+
+
+def _profiled(argv, environ, stdout, stderr, **kw):
+    """Run `context()`, timing its phases.
+
+    CTX_PROFILE=1 prints the timings to stderr, any other value is a file
+    that gets a JSON line for each call. With CTX_PROFILE_STATS set to a
+    file, the cProfile statistics of the whole call are dumped there.
+    """
+    global _profile, _import_start
+    prof = _profile = _Profile()
+    if _import_start is not None:
+        prof.add('startup', _import_start)
+        _import_start = None
+
+    stats_file = environ.get('CTX_PROFILE_STATS')
+    real_import = builtins.__import__
+    builtins.__import__ = prof.import_hook(real_import)
+    t0 = prof.clock()
+    try:
+        if not stats_file:
+            return context(argv, environ, stdout, stderr, **kw)
+        import cProfile
+        cprof = cProfile.Profile()
+        try:
+            return cprof.runcall(context, argv, environ, stdout, stderr, **kw)
+        finally:
+            cprof.dump_stats(stats_file)
+    finally:
+        builtins.__import__ = real_import
+        prof.phases.append(('imports', prof.import_time, None))
+        prof.add('total', t0)
+        _profile = None
+        prof.report(argv, environ['CTX_PROFILE'], stderr)
+
+
+def context(argv, environ, stdout, stderr, *, _now=None, _color=False,
+            _isatty=None, _session=None):
+
+    if _profile is None and environ.get('CTX_PROFILE', '0') != '0':
+        return _profiled(argv, environ, stdout, stderr, _now=_now,
+                         _color=_color, _isatty=_isatty, _session=_session)
+
+    if _session is None and argv[1:2] and argv[1] in _FAST_COMMANDS:
+        status = _fast_context(argv, environ, stdout, _color, _isatty)
+        if status is not None:
+            return status
+
+    opened = []
+    try:
+        return _run_context(argv, environ, stdout, stderr, _now, _color,
+                            _isatty, _session, opened)
+    finally:
+        # close the connections, also when a command failed
+        for c in opened:
+            c.close()
+
+
+def _run_context(argv, environ, stdout, stderr, _now, _color, _isatty,
+                 _session, opened):
+
+    WINDOWS = sys.platform.startswith('win')
+    color, style = _colors(_color, _isatty)
+
 
     def _print_version():
         s = ('shellctx version ',
@@ -235,22 +2824,14 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
         now = _now
 
     ctx_home = environ.get('CTX_HOME', None)
-    if ctx_home is None:
-        ctx = os.path.expanduser('~/.ctx')
-    else:
-        if verbose_flag:
-            print('CTX_HOME=%s' % ctx_home, file=stderr)
-        ctx = ctx_home
+    if ctx_home is not None and verbose_flag:
+        print('CTX_HOME=%s' % ctx_home, file=stderr)
+    ctx = _ctx_home(environ)
 
     os.makedirs(ctx, exist_ok=True)
 
-    # grab the pointer name
     name_file = os.path.join(ctx, '_name.txt')
-    if os.path.exists(name_file):
-        with open(name_file, 'r') as fid:
-            name = fid.read().strip()
-    else:
-        name = 'main'
+    name = _read_name(ctx)
 
 
     if env_name:
@@ -258,43 +2839,30 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
             print('CTX_NAME=%s' % env_name, file=stderr)
         name = env_name
 
-    # TODO: chaining
     chain_names = [i.strip() for i in name.split('+')]
     name = chain_names[0]
 
-    ctx_file = os.path.join(ctx, name + '.json')
-    log_file = os.path.join(ctx, name + '.log')
-
-    if os.path.exists(ctx_file):
-        with open(ctx_file, 'rb') as fid:
-            data = fid.read()
-            _cdict = json.loads(data.decode('utf8'))
+    if _session is None:
+        c = Context('+'.join(chain_names), ctx, environ)
+        opened.append(c)
     else:
-        _cdict = {}
+        # run against the context of an enclosing batch
+        c = _session
+    chain_names = c.chain_names
+    name = c.name
+    cdict = c.cdict
+    _cdict = c.backend
 
+    ctx_file = _cdict.path
 
-    chain_dict = [_cdict]
-    # load the chain
-    for cname in chain_names[1:]:
-        cfile = os.path.join(ctx, cname + '.json')
-        if os.path.exists(cfile):
-            with open(cfile, 'rb') as fid:
-                data = fid.read()
-                ch_dict = json.loads(data.decode('utf8'))
-        else:
-            ch_dict = {}
-        chain_dict.append(ch_dict)
+    def iter_log(since=None):
+        return _cdict.iter_log(since)
 
-    cdict = collections.ChainMap(*chain_dict)
+    def tail_log(count):
+        return _cdict.tail_log(count)
 
     def load_log():
-        if os.path.exists(log_file):
-            with open(log_file, 'rb') as fid:
-                data = fid.read()
-                log = json.loads(data.decode('utf8'))
-        else:
-            log = []
-        return log
+        return list(iter_log())
 
 
 
@@ -349,10 +2917,40 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
 
     if cmd is None:
         cmd = '_fullitems'
+    elif cmd in _PAGE_OPTIONS or cmd == '--format':
+        # `ctx --limit N` pages the default view
+        argv = (argv[0], '_fullitems') + tuple(argv[1:])
+        cmd = '_fullitems'
+
+    out_format = None
+    if cmd in ('keys', 'items', '_fullitems') and '--format' in argv[2:]:
+        # --format FMT, taken out of the arguments of the command
+        i = list(argv).index('--format', 2)
+        if i + 1 >= len(argv) or argv[i + 1] not in _FORMATS:
+            raise ValueError('--format takes one of: %s'
+                             % ', '.join(_FORMATS))
+        out_format = argv[i + 1]
+        argv = tuple(argv[:i]) + tuple(argv[i + 2:])
 
     need_store = False
     log_extra = []  # for extra logging information
 
+    # an open transaction, see the `txn` command
+    txn = None
+    txn_file = None
+    txn_id = environ.get('CTX_TXN')
+    if cmd == 'txn' and key in ('commit', 'abort') and value:
+        txn_id = value
+    if _session is None and txn_id and not (cmd == 'txn' and key == 'begin'):
+        txn_file = os.path.join(ctx, '_txn', txn_id + '.json')
+        txn = _load_txn(txn_file, name)
+        # show the staged changes to the commands of the transaction,
+        # in memory over the context, which is left as it is
+        _cdict = _Staged(c.backend, txn['set'], txn['del'])
+        c.backend = cdict.maps[0] = _cdict
+
+    if _profile is not None:
+        t_command = _profile.clock()
 
     if cmd == 'args':
         _print_args()
@@ -371,12 +2969,7 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
                 # double-quote the path due to spaces
                 store = '"%s"' % store
 
-        # rewrite for the log
-        cmd = 'set'
-        value = store
-
-        cdict[key] = (now, store)
-        need_store = True
+        c.set(key, store, now)
 
         s = (style['key'],
              key,
@@ -389,7 +2982,7 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
         print(''.join(s), file=stdout)
 
     elif cmd == 'get':
-        v = cdict[key][1]
+        v = c[key]
         s = (style['value'],
             v,
             color[''],
@@ -445,6 +3038,32 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
         else:
             print('dryrun ' + ''.join(s), file=stdout)
 
+    elif cmd == 'execvp':
+        # like exec, but the command replaces this process, so signals
+        # and the exit status pass through and no interpreter is left
+        import shlex
+
+        if _session is not None:
+            # the batch would end here without storing its changes
+            raise ValueError('execvp cannot run in a batch')
+
+        args = shlex.split(cdict[key][1])
+        args.extend(argv[3:])
+        if verbose_flag:
+            print('execvp command: %r' % args, file=stderr)
+
+        if WINDOWS:
+            # os.exec* on Windows starts a new process and exits
+            import subprocess
+            retcode = subprocess.call(args)
+        else:
+            path = _resolve_exec(args[0], ctx, environ)
+            if path is None:
+                raise FileNotFoundError('command not found: %r' % args[0])
+            stdout.flush()
+            stderr.flush()
+            os.execve(path, args, environ)
+
     elif cmd == '_pop':  # may remove
         print(cdict[key][1], end='', file=stdout)
         del cdict[key]
@@ -452,32 +3071,44 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
 
     elif cmd == 'set':
         assert(value is not None)
-        cdict[key] = (now, value)
-        need_store = True
+        c.set(key, value, now)
 
     elif cmd == 'del':
-        del cdict[key]
+        # all keys must exist before any is deleted
+        keys = [key]
         if value:
-            # TODO: ensure all keys exist before
-            # for deleting multiple keys
-            for v in value.split():
-                del cdict[v]
-
-            # TODO: if 'unset', then ignore if missing
+            keys.extend(value.split())
+        c.delete(*keys, now=now)
 
-        need_store = True
+        # TODO: if 'unset', then ignore if missing
 
     elif cmd == 'keys':
-        keys = sorted(cdict.keys())
-        for k in keys:
-            s = (style['key'],
-                k,
-                color[''],
-                )
-            print(''.join(s), file=stdout)
+        # keys [--prefix P] [--glob PATTERN] [--regex RE]
+        query = {}
+        args = list(argv[2:])
+        while args:
+            opt = args.pop(0)
+            if opt in ('--prefix', '--glob', '--regex') and args:
+                query[opt[2:]] = args.pop(0)
+            else:
+                raise ValueError('invalid keys option: %r' % opt)
+        keys = c.match_keys(**query) if query else c.keys()
+        if out_format is not None:
+            _write_rows(stdout, out_format, ((k,) for k in keys))
+        else:
+            for k in keys:
+                s = (style['key'],
+                    k,
+                    color[''],
+                    )
+                print(''.join(s), file=stdout)
 
     elif cmd == 'rename':
         assert(len(value.split()) == 1)
+        # only keys of the first context can be deleted, check first
+        if key not in _cdict:
+            raise KeyError(
+                'Key not found in the first mapping: {!r}'.format(key))
         v = cdict[key]
         cdict[value] = v
         del cdict[key]
@@ -495,57 +3126,73 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
 
         # allow for `ctx items | ctx update -" to preserve time order
         x = ' '.join(argv[2:])
-        if x:
+        if len(argv) > 2 and argv[2] == '--match':
+            # items --match GLOB
+            if len(argv) != 4:
+                raise ValueError('items --match takes one pattern')
+            items = sorted(
+                (cdict[k][0], k, cdict[k][1])
+                for k in c.match_keys(glob=argv[3]))
+        elif len(argv) > 2 and argv[2] in _PAGE_OPTIONS:
+            # the newest items, still printed oldest first
+            items = c.latest(**_page_options(argv[2:]))[::-1]
+        elif x:
             keys = x.split()
             items = [
                 (cdict[k][0], k, cdict[k][1])
                 for k in keys
                 ]
         else:
-            everything = [(v[0], k, v[1]) for k, v in cdict.items()]
+            everything = [(v[0], k, v[1]) for k, v in c.merged().items()]
             items = sorted(everything)
 
-        # make the output resemble `env`
-        for ctime, _key, _value in items:
-            s = (style['key'], _key, color[''], '=',
-                 style['value'],
-                 _value,
-                 color['']
-            )
-            print(''.join(s), file=stdout)
+        if out_format is not None:
+            _write_rows(stdout, out_format, (i[1:] for i in items))
+        else:
+            # make the output resemble `env`
+            for ctime, _key, _value in items:
+                s = (style['key'], _key, color[''], '=',
+                     style['value'],
+                     _value,
+                     color['']
+                )
+                print(''.join(s), file=stdout)
 
     elif cmd == '_fullitems':
-        # timestamp, key, value
-        everything = [(v[0], k, v[1]) for k, v in cdict.items()]
-        x = sorted(everything, reverse=True)
-        names = '+'.join(chain_names)
-        s = ('Using context ', style['context'], names, color[''], '')
-        if env_name:
-            s = s + (' (set by CTX_NAME)', )
-        if ctx_home:
-            s = s + ((' (from CTX_HOME=%s)' % ctx_home),)
-        print(''.join(s), file=stdout)
-        s = ('There are ', style['value'], str(len(everything)),
-            color[''], ' entries.\n')
-        print(''.join(s), file=stdout)
-
-        for ctime, _key, _value in x:
-            value=str(value)
-            s = (style['time'],
-                 ctime, '    ',
-                 style['key'], _key,
-                 color[''], ' = ',
-                 style['value'], _value,
-                 color['']
-                 )
+        # timestamp, key, value, newest first
+        x = c.latest(**_page_options(argv[2:]))
+        if out_format is not None:
+            _write_rows(stdout, out_format, x)
+        else:
+            names = '+'.join(chain_names)
+            s = ('Using context ', style['context'], names, color[''], '')
+            if env_name:
+                s = s + (' (set by CTX_NAME)', )
+            if ctx_home:
+                s = s + ((' (from CTX_HOME=%s)' % ctx_home),)
+            print(''.join(s), file=stdout)
+            s = ('There are ', style['value'], str(len(c)),
+                color[''], ' entries.\n')
             print(''.join(s), file=stdout)
 
+            for ctime, _key, _value in x:
+                value=str(value)
+                s = (style['time'],
+                     ctime, '    ',
+                     style['key'], _key,
+                     color[''], ' = ',
+                     style['value'], _value,
+                     color['']
+                     )
+                print(''.join(s), file=stdout)
+
     elif cmd == 'switch':
         if key is None:
             # print all the context names
-            f = os.listdir(ctx)
-            ext = '.json'
-            f = [i.rpartition(ext)[0] for i in f if i.endswith(ext)]
+            exts = tuple(cls.ext for cls in _BACKENDS.values())
+            f = [i.rpartition('.')[0] for i in os.listdir(ctx)
+                 if i.endswith(exts)]
+            f = list(collections.OrderedDict.fromkeys(f))
             if name not in f:
                 f.append(name)
             for i in sorted(f):
@@ -588,8 +3235,7 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
                     )
                 print(''.join(s), file=stdout)
                 # switch to the context, if available
-                with open(name_file, 'w') as fid:
-                    fid.write(key)
+                _atomic_write(name_file, key.encode('utf8'))
             else:
                 s = ('already on "',
                     style['context'],
@@ -623,31 +3269,110 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
         #   ctx update kv.txt
         assert(key is not None)
         assert(value is None)
-        # key is a file, - for stdin. readlines,
+        # key is a file, - for stdin, read line by line
         if key == '-':
             fid = sys.stdin
         else:
             fid = open(key, 'r')
 
-        # process the lines
-        d = {}
-        now2 = now
-        for line in fid.readlines():
-            _key, eq, _value = line.partition('=')
-            _value = _value.rstrip() # strip newline
-            d[_key] = (now2, _value)
-            log_extra.append((now2, 'update_set', _key, _value))
-
-            while True:  # ensure unique now
-                _now2 = get_now()
-                if _now2 != now2:
-                    now2 = _now2
-                    break
-
-        fid.close()
-        # update if no error occurs
-        cdict.update(d)
-        need_store = True
+        def pairs():
+            for line in fid:
+                _key, eq, _value = line.partition('=')
+                yield _key, _value.rstrip() # strip newline
+
+        # unique timestamps in input order
+        with fid:
+            c.update(pairs(), now, source=key)
+
+    elif cmd == 'txn' and key == 'begin':
+        # stage the changes of later commands run with CTX_TXN set
+        #   export CTX_TXN=`ctx txn begin`
+        if txn_id:
+            raise ValueError('transaction %s already open' % txn_id)
+        txn_id = os.urandom(8).hex()
+        txn_file = os.path.join(ctx, '_txn', txn_id + '.json')
+        os.makedirs(os.path.dirname(txn_file), exist_ok=True)
+        _save_txn(txn_file, {'name': name, 'set': {}, 'del': [], 'log': []})
+        print(txn_id, file=stdout)
+
+    elif cmd == 'txn' and key == 'commit':
+        # the staged changes are already applied, store them at once
+        if txn is None:
+            raise ValueError('no open transaction, set CTX_TXN')
+        # the staged records are older, keep the log in time order
+        c.record(txn['log'])
+        c.record([(now, cmd, key, value)])
+
+    elif cmd == 'txn' and key == 'abort':
+        if txn is None:
+            raise ValueError('no open transaction, set CTX_TXN')
+        os.remove(txn_file)
+        txn = None
+        c.rollback()
+
+    elif cmd in ('batch', 'txn'):
+        # run commands from a file, - for stdin, against one loaded
+        # context and store all the changes once at the end
+        #   ctx batch -         one command per line, shell quoted
+        #   ctx batch -0 -      NUL-terminated arguments, with an empty
+        #                       argument after each command
+        # a txn stops at the first failure and stores nothing
+        args = list(argv[2:])
+        null = '-0' in args
+        if null:
+            args.remove('-0')
+        source = args[0] if args else '-'
+
+        if _session is not None:
+            raise ValueError('%s cannot be nested' % cmd)
+        if cmd == 'txn' and txn is not None:
+            # storing at the end would commit the open transaction too
+            raise ValueError('transaction %s already open' % txn_id)
+
+        if source == '-':
+            fid = sys.stdin
+        else:
+            fid = open(source, 'r')
+
+        mark = len(c._log)
+        failed = 0
+        backend = c.backend
+        with fid:
+            for n, bargv in enumerate(_read_batch(fid, null), 1):
+                # each command changes a layer that is dropped if it fails
+                layer = _Staged(backend)
+                c.backend = cdict.maps[0] = layer
+                cmd_mark = len(c._log)
+                try:
+                    status = context(
+                        ['ctx'] + bargv, environ, stdout, stderr,
+                        _now=_now, _color=_color, _isatty=_isatty,
+                        _session=c)
+                except Exception as exc:
+                    status = '%s: %s' % (type(exc).__name__, exc)
+                finally:
+                    c.backend = cdict.maps[0] = backend
+
+                if not status:
+                    layer.apply()
+                else:
+                    del c._log[cmd_mark:]
+                    failed += 1
+                    if isinstance(status, int):
+                        status = 'exit status %i' % status
+                    s = ('%s command %i failed: ' % (cmd, n),
+                         color['red'], status, color[''])
+                    print(''.join(s), file=stderr)
+                    if cmd == 'txn':
+                        break
+
+        if failed:
+            retcode = 1
+        if failed and cmd == 'txn':
+            c.rollback()
+            print('transaction aborted, nothing stored', file=stderr)
+        elif len(c._log) > mark:
+            c._log.insert(mark, [(now, cmd, key, value)])
 
     elif cmd == 'clear':
         # require clear to have the key as a failsafe
@@ -658,40 +3383,33 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
     elif cmd == '_delctx':
         assert(key is not None)
         assert(value is None)
-        _ctx_file = os.path.join(ctx, key + '.json')
-        _log_file = os.path.join(ctx, key + '.log')
-        if os.path.exists(_ctx_file):
-            os.remove(_ctx_file)
-        if os.path.exists(_log_file):
-            os.remove(_log_file)
+        for cls in _BACKENDS.values():
+            cls(ctx, key, environ).remove()
 
     elif cmd in ('version', '-v'):
         _print_version()
 
     elif cmd == 'entry':
-        # auto-increment the maximum suffix for a key
+        # auto-increment the suffix for a key
         assert(key is not None)
         assert(value is not None)
-        # use key as a prefix
+        # use key as a prefix, numbered by a stored counter
         prefix = key + '_'
-        N = len(prefix)
-        keys = list(cdict.keys())
-        suffix = [i[N:] for i in keys if i.startswith(prefix)]
-
-        nums = []
-        for n in suffix:
-            try:
-                nums.append(int(n))
-            except:
-                pass
 
-        if not nums:
-            nums.append(0)
-
-        next_num = max(nums) + 1
-
-        key = prefix + ('%03i' % next_num)
-        assert(key not in cdict)  # must be new key
+        def highest():
+            # the largest number in use, when the counter is missing
+            nums = [0]
+            for k in c.match_keys(prefix=prefix):
+                try:
+                    nums.append(int(k[len(prefix):]))
+                except ValueError:
+                    pass
+            return max(nums)
+
+        while True:
+            key = prefix + ('%03i' % _cdict.next_counter(prefix, highest))
+            if key not in cdict:  # skip numbers set by hand
+                break
 
         cdict[key] = (now, value)
 
@@ -784,30 +3502,278 @@ def context(argv, environ, stdout, stderr, *, _now=None, _color=False):
             print(''.join(s), file=stdout)
 
 
+    if _profile is not None:
+        _profile.add('command ' + cmd, t_command)
+
     if need_store:
+        c.record([(now, cmd, key, value)])
+        c.record(log_extra)
+
+    # an enclosing batch stores the changes of its commands at the end
+    if _session is None:
+        if not c.dirty:
+            c.rollback()  # nothing to store
+        elif txn is not None and cmd != 'txn':
+            # stage all the changes so far instead of storing them
+            txn['set'], txn['del'] = _cdict.changes()
+            txn['log'].extend(c.pending())
+            _save_txn(txn_file, txn)
+            c.rollback()
+        else:
+            c.flush()
+            if txn is not None:
+                os.remove(txn_file)  # committed
 
-        bdata = json.dumps(_cdict, indent=4).encode('utf8')
-        with open(ctx_file, 'wb') as fid:
-            fid.write(bdata)
+    return retcode
 
-        log = load_log()
-        log.append((now, cmd, key, value))
-        if log_extra:
-            log.extend(log_extra)
 
-        bdata = json.dumps(log, indent=4).encode('utf8')
-        with open(log_file, 'wb') as fid:
-            fid.write(bdata)
+# A resident daemon keeps parsed contexts in memory and runs `context()`
+# on behalf of clients connecting over a Unix domain socket. Commands
+# that depend on the client process (working directory, stdin, running
+# programs) always run directly in the client.
 
-    return retcode
+_DAEMON_COMMANDS = {
+    '_fullitems', 'get', 'set', 'del', 'keys', 'items', 'name', 'copy',
+    'rename', 'entry', 'import', 'now', 'version', '-v', 'log', 'clear',
+    '_pop', '_dict', 'switch', 'help', '-h', 'dryshell', 'dryexec',
+    }
+
+# Commands that change nothing, so they can safely run again directly
+# when the daemon is slow to reply.
+_DAEMON_READ_ONLY = {
+    '_fullitems', 'get', 'keys', 'items', 'name', 'now', 'version', '-v',
+    'log', '_dict', 'help', '-h', 'dryshell', 'dryexec',
+    }
+
+# Seconds the daemon waits for the request of a connected client, and a
+# client waits for the reply to a read-only command.
+_DAEMON_RECV_TIMEOUT = 1.0
+_DAEMON_READ_TIMEOUT = 2.0
+
+
+def _daemon_socket(environ):
+    return os.path.join(_ctx_home(environ), '_daemon.sock')
+
+
+def _send_msg(sock, obj):
+    import json
+    data = json.dumps(obj).encode('utf8')
+    sock.sendall(len(data).to_bytes(4, 'big') + data)
+
+
+def _recv_exact(sock, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        buf += chunk
+    return buf
+
+
+def _recv_msg(sock):
+    import json
+    size = int.from_bytes(_recv_exact(sock, 4), 'big')
+    return json.loads(_recv_exact(sock, size).decode('utf8'))
+
+
+def _daemon_request(environ, request, timeout=None, retry=True):
+    """Send a request to the daemon, returning None if it is not running.
+
+    Once the request is sent, a failure or a `timeout` waiting for the
+    reply also returns None when `retry` is true. Otherwise the error is
+    raised, since the daemon may still carry out the request.
+    """
+    sock_file = _daemon_socket(environ)
+    if not os.path.exists(sock_file):
+        return None
+
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            # a partly sent request is dropped by the daemon
+            sock.settimeout(1.0)
+            sock.connect(sock_file)
+            _send_msg(sock, request)
+        except OSError:
+            return None
+        try:
+            sock.settimeout(timeout)
+            return _recv_msg(sock)
+        except OSError:
+            if retry:
+                return None
+            raise
+    finally:
+        sock.close()
+
+
+def _daemon_call(argv, environ, stdout, stderr, *, _color=False,
+                 _isatty=None):
+    """Run a command through the daemon, or return None to run directly."""
+    cmd = argv[1] if len(argv) > 1 else '_fullitems'
+    if cmd not in _DAEMON_COMMANDS:
+        return None
+
+    if _isatty is None:
+        _isatty = sys.stdout.isatty()
+
+    request = {
+        'op': 'context',
+        'argv': list(argv),
+        'environ': dict(environ),
+        'color': _color,
+        'isatty': _isatty,
+        }
+    # a change is never run twice, so only wait a bounded time for reads
+    if cmd in _DAEMON_READ_ONLY:
+        reply = _daemon_request(environ, request, _DAEMON_READ_TIMEOUT)
+    else:
+        try:
+            reply = _daemon_request(environ, request, retry=False)
+        except OSError as e:
+            print('no reply from the ctx daemon (%s), the change may not '
+                  'be stored' % e, file=stderr)
+            return 1
+    if reply is None or reply.get('error'):
+        # an exception is reproduced by running directly
+        return None
+
+    stdout.write(reply['stdout'])
+    stderr.write(reply['stderr'])
+    return reply['status']
+
+
+def _daemon_serve(sock_file):
+    """Serve requests on the socket until a stop request arrives."""
+    global _parsed_cache
+    import io
+    import socket
+
+    _parsed_cache = {}
+
+    if os.path.exists(sock_file):
+        os.remove(sock_file)  # left behind by a daemon that died
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_file)
+    server.listen(16)
+
+    running = True
+    try:
+        while running:
+            conn, _ = server.accept()
+            with conn:
+                # a client that sends nothing must not stall the others
+                conn.settimeout(_DAEMON_RECV_TIMEOUT)
+                try:
+                    request = _recv_msg(conn)
+                except (OSError, ValueError):
+                    continue
+
+                op = request.get('op')
+                if op == 'context':
+                    out = io.StringIO()
+                    err = io.StringIO()
+                    try:
+                        status = context(
+                            request['argv'], request['environ'], out, err,
+                            _color=request['color'],
+                            _isatty=request['isatty'])
+                        reply = {'stdout': out.getvalue(),
+                                 'stderr': err.getvalue(),
+                                 'status': status}
+                    except BaseException:
+                        reply = {'error': True}
+                elif op == 'stop':
+                    # stop listening before replying, so the socket is
+                    # gone once the client sees the reply
+                    running = False
+                    server.close()
+                    os.remove(sock_file)
+                    reply = {'pid': os.getpid()}
+                else:
+                    reply = {'pid': os.getpid()}
+
+                try:
+                    _send_msg(conn, reply)
+                except OSError:
+                    pass
+    finally:
+        server.close()
+        if os.path.exists(sock_file):
+            os.remove(sock_file)
+        _parsed_cache = None
+
+
+@reg('daemon', "Manage the resident ctx daemon",
+     """daemon start|stop|status|run""")
+def daemon(ctx):
+    action = ctx.key or 'status'
+    sock_file = _daemon_socket(ctx.environ)
+
+    if action == 'run':
+        _daemon_serve(sock_file)
+
+    elif action == 'start':
+        import subprocess
+        import time
+        if _daemon_request(ctx.environ, {'op': 'ping'}) is not None:
+            print('daemon already running', file=ctx.stdout)
+            return 0
+        os.makedirs(ctx.ctx, exist_ok=True)
+        env = dict(ctx.environ)
+        env['CTX_HOME'] = ctx.ctx
+        subprocess.Popen(
+            [sys.executable, '-m', 'shellctx.ctx', 'daemon', 'run'],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True)
+        for _ in range(100):
+            reply = _daemon_request(ctx.environ, {'op': 'ping'})
+            if reply is not None:
+                print('daemon started, PID %i' % reply['pid'],
+                      file=ctx.stdout)
+                return 0
+            time.sleep(0.02)
+        print('daemon did not start', file=ctx.stderr)
+        return 1
+
+    elif action == 'stop':
+        reply = _daemon_request(ctx.environ, {'op': 'stop'})
+        if reply is None:
+            print('daemon not running', file=ctx.stdout)
+        else:
+            print('daemon stopped, PID %i' % reply['pid'], file=ctx.stdout)
+
+    elif action == 'status':
+        reply = _daemon_request(ctx.environ, {'op': 'ping'})
+        if reply is None:
+            print('daemon not running', file=ctx.stdout)
+            return 1
+        print('daemon running, PID %i' % reply['pid'], file=ctx.stdout)
+
+    else:
+        print('unknown daemon action: %r' % action, file=ctx.stderr)
+        return 1
+
+
+def main():
+    argv = list(sys.argv)
+    environ = dict(os.environ)
+    status = _daemon_call(argv, environ, sys.stdout, sys.stderr,
+                          _color=True)
+    if status is None:
+        status = context(argv, environ, sys.stdout, sys.stderr,
+                         _color=True)
+    return status
 
 
 if __name__ == '__main__':
-    status = context(
-        list(sys.argv),
-        dict(os.environ),
-        sys.stdout,
-        sys.stderr,
-        _color=True
-        )
-    sys.exit(status)
+    sys.exit(main())
@@ -6,6 +6,7 @@ import unittest
 import shutil
 import os
 import io
+import sys
 import json
 import datetime
 import tempfile
@@ -112,6 +113,648 @@ class TestContext(unittest.TestCase):
         self.assertEqual(v, {})
 
 
+    def test_concurrent_set(self):
+        # writers merge their changes instead of losing updates
+        import threading
+
+        def worker(n):
+            for i in range(10):
+                ctx.context(('ctx', 'set', 'k%i_%i' % (n, i), 'x'),
+                            self.environ, io.StringIO(), io.StringIO(),
+                            _now=NOW)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        v = self.load_ctx('main')
+        self.assertEqual(len(v), 40)
+
+        log_file = os.path.join(self.TMP_DIR, 'main.log')
+        with open(log_file, 'r') as fid:
+            self.assertEqual(len(fid.read().splitlines()), 40)
+
+    def test_concurrent_sqlite(self):
+        # processes creating a new database do not fail on each other
+        import subprocess
+        env = dict(self.environ, CTX_BACKEND='sqlite')
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(ctx.__file__))
+        for name in ('a', 'b'):
+            env['CTX_NAME'] = name
+            procs = []
+            for n in range(8):
+                for argv in (('set', 'k%i' % n, 'x'), ('entry', 'e', 'x')):
+                    procs.append(subprocess.Popen(
+                        [sys.executable, '-m', 'shellctx.ctx'] + list(argv),
+                        env=env, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE))
+            for p in procs:
+                _, err = p.communicate()
+                self.assertEqual((p.returncode, err), (0, b''))
+            self.assertEqual(len(ctx.Context(environ=env)), 16)
+
+    @unittest.skipUnless(hasattr(__import__('socket'), 'AF_UNIX'),
+                         'needs Unix domain sockets')
+    def test_daemon(self):
+        env = self.environ.copy()
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(ctx.__file__))
+
+        # no daemon, run directly
+        status = ctx._daemon_call(('ctx', 'get', 'a'), env,
+                                  self.stdout, self.stderr)
+        self.assertIsNone(status)
+
+        status = ctx.context(('ctx', 'daemon', 'start'), env,
+                             self.stdout, self.stderr)
+        self.assertEqual(status, 0)
+        try:
+            self._check_daemon(env)
+        finally:
+            ctx.context(('ctx', 'daemon', 'stop'), env,
+                        io.StringIO(), io.StringIO())
+
+    def _check_daemon(self, env):
+        self.reset_output()
+        for argv in [('ctx', 'set', 'a', '1 2'),
+                     ('ctx', 'get', 'a'),
+                     ('ctx', 'items'),
+                     ('ctx', 'name')]:
+            out = io.StringIO()
+            err = io.StringIO()
+            status = ctx._daemon_call(argv, env, out, err)
+            self.assertEqual(status, 0)
+            self.assertEqual(err.getvalue(), '')
+            ctx.context(argv, env, self.stdout, self.stderr)
+            self.assertEqual(out.getvalue(), self.stdout.getvalue())
+            self.reset_output()
+
+        # errors are reproduced by running directly
+        status = ctx._daemon_call(('ctx', 'get', 'MISSING'), env,
+                                  self.stdout, self.stderr)
+        self.assertIsNone(status)
+
+        # commands tied to the client process are not forwarded
+        status = ctx._daemon_call(('ctx', 'setpath', 'p', '.'), env,
+                                  self.stdout, self.stderr)
+        self.assertIsNone(status)
+
+        # a client that sends nothing does not hold up the others
+        import socket
+        import time
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(ctx._daemon_socket(env))
+        try:
+            t0 = time.monotonic()
+            status = ctx._daemon_call(('ctx', 'set', 'b', '2'), env,
+                                      io.StringIO(), io.StringIO())
+            self.assertEqual(status, 0)
+            self.assertLess(time.monotonic() - t0,
+                            ctx._DAEMON_RECV_TIMEOUT + 1)
+        finally:
+            stalled.close()
+
+    @unittest.skipIf(os.name == 'nt', 'no Unix domain sockets on Windows')
+    def test_daemon_no_reply(self):
+        import socket
+        import threading
+        import unittest.mock
+
+        def listen():
+            # a daemon that takes requests but never replies
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(ctx._daemon_socket(self.environ))
+            server.listen(4)
+            return server
+
+        def close(server):
+            server.close()
+            os.remove(ctx._daemon_socket(self.environ))
+
+        # a read runs directly after a short wait
+        server = listen()
+        try:
+            with unittest.mock.patch.object(ctx, '_DAEMON_READ_TIMEOUT',
+                                            0.1):
+                status = ctx._daemon_call(('ctx', 'get', 'a'),
+                                          self.environ,
+                                          self.stdout, self.stderr)
+            self.assertIsNone(status)
+        finally:
+            close(server)
+
+        # a change the daemon may have stored is not run again
+        server = listen()
+
+        def drop():
+            conn, _ = server.accept()
+            with conn:
+                ctx._recv_msg(conn)
+
+        thread = threading.Thread(target=drop)
+        thread.start()
+        try:
+            status = ctx._daemon_call(('ctx', 'set', 'a', '1'),
+                                      self.environ, self.stdout, self.stderr)
+        finally:
+            thread.join()
+            close(server)
+        self.assertEqual(status, 1)
+        self.assertIn('no reply from the ctx daemon', self.stderr.getvalue())
+        self.assertFalse(os.path.exists(self._ctx_file))
+
+    @unittest.skipIf(os.name == 'nt', 'no waitpid on Windows')
+    def test_waitpid(self):
+        import subprocess
+        import unittest.mock
+
+        def spawn(secs):
+            return subprocess.Popen(
+                [sys.executable, '-c', 'import time; time.sleep(%s)' % secs])
+
+        fast, slow = spawn(0.1), spawn(0.5)
+        with unittest.mock.patch.object(ctx, '_do_message_box') as mbox:
+            status = ctx.context(
+                ('ctx', 'waitpid', str(fast.pid), str(slow.pid), '--',
+                 'done'), self.environ, self.stdout, self.stderr)
+        self.assertEqual(status, 0)
+        lines = self.stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('PID %i finished' % fast.pid))
+        self.assertTrue(lines[1].startswith('PID %i finished' % slow.pid))
+        self.assertTrue(mbox.call_args[0][1].endswith('\ndone'))
+
+        # without `--`, the message follows the one PID
+        fast = spawn(0.1)
+        with unittest.mock.patch.object(ctx, '_do_message_box') as mbox:
+            status = ctx.context(
+                ('ctx', 'waitpid', str(fast.pid), '99999', 'builds', 'done'),
+                self.environ, self.stdout, self.stderr)
+        self.assertEqual(status, 0)
+        self.assertEqual(mbox.call_args[0][1], 'waitpid %i finished\n'
+                         '99999 builds done' % fast.pid)
+
+        # polling, where pidfds are not available
+        fast, slow = spawn(0.1), spawn(30)
+        try:
+            with unittest.mock.patch.object(ctx.os, 'pidfd_open',
+                                            side_effect=OSError, create=True):
+                running = ctx._wait_pids([fast.pid, slow.pid], wait_all=False)
+                self.assertEqual(running, [slow.pid])
+                running = ctx._wait_pids([slow.pid], timeout=0.2)
+                self.assertEqual(running, [slow.pid])
+
+            self.reset_output()
+            status = ctx.context(
+                ('ctx', 'waitpid', '--timeout', '0.2', str(slow.pid)),
+                self.environ, self.stdout, self.stderr)
+            self.assertEqual(status, 124)
+            self.assertIn('still running: %i' % slow.pid,
+                          self.stderr.getvalue())
+        finally:
+            slow.kill()
+            slow.wait()
+
+    def test_map(self):
+        import shlex
+        script = 'import sys, time; time.sleep(float(sys.argv[1])); ' \
+                 'print(sys.argv[1]); sys.exit(int(sys.argv[2]))'
+        self.write_ctx({'job': [NOW, '%s -c %s' % (
+            shlex.quote(sys.executable), shlex.quote(script))]})
+        arg_file = os.path.join(self.TMP_DIR, 'args.txt')
+        with open(arg_file, 'w') as fid:
+            fid.write('0.3 0\n0.0 2\n\n0.1 0\n')
+
+        status = ctx.context(('ctx', 'map', 'job', '-j', '3', arg_file),
+                             self.environ, self.stdout, self.stderr)
+        self.assertEqual(status, 1)
+        self.assertEqual(self.stdout.getvalue().split(),
+                         ['0.0', '0.1', '0.3'])
+        self.assertIn('1 of 3 jobs failed', self.stderr.getvalue())
+        self.assertIn('exit status 2: 0.0 2', self.stderr.getvalue())
+
+        self.reset_output()
+        ctx.context(('ctx', 'map', 'job', '-j', '3', '--ordered', arg_file),
+                    self.environ, self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue().split(),
+                         ['0.3', '0.0', '0.1'])
+
+    @unittest.skipIf(os.name == 'nt', 'uses a POSIX shell')
+    def test_run(self):
+        out = os.path.join(self.TMP_DIR, 'out.txt')
+        src = os.path.join(self.TMP_DIR, 'src.txt')
+        with open(src, 'w') as fid:
+            fid.write('1')
+        self.write_ctx({
+            'a': [NOW, 'echo a >> %s' % out],
+            'b': [NOW, 'echo b >> %s' % out],
+            'c': [NOW, 'echo c >> %s' % out],
+            '_dep_c': [NOW, 'a b'],
+            '_in_b': [NOW, src],
+            })
+
+        def run(*args):
+            self.reset_output()
+            return ctx.context(('ctx',) + args, self.environ,
+                               self.stdout, self.stderr)
+
+        run('dryrun', 'c')
+        self.assertEqual(self.stdout.getvalue().splitlines()[-1],
+                         'dryrun wave 2: c: echo c >> %s' % out)
+        self.assertEqual(run('run', 'c', '-j', '2'), 0)
+        with open(out) as fid:
+            self.assertEqual(sorted(fid.read().split()), ['a', 'b', 'c'])
+
+        # nothing changed, then an input of b changed
+        run('run', 'c')
+        with open(src, 'w') as fid:
+            fid.write('22')
+        run('run', 'c')
+        with open(out) as fid:
+            self.assertEqual(sorted(fid.read().split()),
+                             ['a', 'b', 'b', 'c', 'c'])
+
+        run('set', 'b', 'false')
+        self.assertEqual(run('run', 'c'), 1)
+        self.assertIn('run b failed', self.stderr.getvalue())
+
+        run('set', '_dep_a', 'c')
+        with self.assertRaises(ValueError):
+            run('run', 'c')
+
+    def test_compression(self):
+        env = dict(self.environ, CTX_COMPRESS='6', CTX_COMPRESS_MIN='100')
+        big = ':'.join(['/usr/local/bin', '/usr/bin', '/bin'] * 50)
+        marked = '\0z:not compressed'
+
+        def run(environ, *args):
+            self.reset_output()
+            ctx.context(('ctx',) + args, environ, self.stdout, self.stderr,
+                        _now=NOW)
+            return self.stdout.getvalue()
+
+        run(env, 'set', 'path', big)
+        for i in range(100):
+            run(env, 'set', 'x%i' % i, 'value %i' % i)
+        main = os.path.join(self.TMP_DIR, 'main.json')
+        log = os.path.join(self.TMP_DIR, 'main.log')
+        with open(main, 'rb') as fid:
+            data = fid.read()
+        self.assertEqual(data[:2], b'\x1f\x8b')
+        stored = json.loads(ctx._gunzip(data).decode('utf8'))
+        self.assertTrue(stored['path'][1].startswith('\0z:'))
+        self.assertEqual(stored['x0'][1], 'value 0')
+        self.assertEqual(run(env, 'get', 'path'), big + '\n')
+
+        # the sizes go down, and the log is kept plain
+        import re
+        sizes = {m[0]: (int(m[1]), int(m[2])) for m in re.findall(
+            r'  (\S.*?) +(\d+) bytes +(\d+) uncompressed', run(env, 'stats'))}
+        self.assertLess(sizes['main.json'][0], sizes['main.json'][1] / 2)
+        self.assertLess(sizes['1 packed values'][0],
+                        sizes['1 packed values'][1] / 2)
+        self.assertEqual(sizes['main.log'][0], os.path.getsize(log))
+        self.assertEqual(sizes['main.log'][0], sizes['main.log'][1])
+
+        # without compression, the files are written plainly again
+        c = ctx.Context(environ=self.environ)
+        c.set('marked', marked, now=NOW)
+        c.flush()
+        self.assertEqual(self.load_ctx('main')['path'][1], big)
+        self.assertEqual(ctx.Context(environ=self.environ)['marked'], marked)
+        self.assertEqual([r[2] for r in c.backend.iter_log()],
+                         ['path'] + ['x%i' % i for i in range(100)]
+                         + ['marked'])
+
+        # values are compressed in SQLite, not the database
+        env = dict(env, CTX_BACKEND='sqlite', CTX_NAME='lite')
+        run(env, 'set', 'path', big)
+        self.assertEqual(run(env, 'get', 'path'), big + '\n')
+        b = ctx._open_backend(self.TMP_DIR, 'lite', env)
+        self.assertTrue(b.stored_values()[0].startswith('\0z:'))
+
+    def test_sqlite_backend(self):
+        env = self.environ.copy()
+        env['CTX_BACKEND'] = 'sqlite'
+
+        def run(*argv, now=NOW):
+            self.reset_output()
+            ctx.context(('ctx',) + argv, env, self.stdout, self.stderr,
+                        _now=now)
+            return self.stdout.getvalue()
+
+        run('set', 'b', '2', now='1971' + NOW[4:])
+        run('set', 'a', '1')
+        run('set', 'c', '3')
+        run('del', 'c')
+        self.assertTrue(os.path.exists(
+            os.path.join(self.TMP_DIR, 'main.sqlite')))
+        self.assertFalse(os.path.exists(self._ctx_file))
+
+        self.assertEqual(run('get', 'a'), '1\n')
+        self.assertEqual(run('keys'), 'a\nb\n')
+        self.assertEqual(run('items'), 'a=1\nb=2\n')
+        self.assertEqual(len(run('log').splitlines()), 4)
+        self.assertEqual(run('log', '--tail', '1'),
+                         "['%s', 'del', 'c', None]\n" % NOW)
+
+        # an existing context keeps its backend
+        del env['CTX_BACKEND']
+        self.assertEqual(run('get', 'b'), '2\n')
+
+    def test_sqlite_lock(self):
+        import sqlite3
+        env = dict(self.environ, CTX_BACKEND='sqlite')
+        path = os.path.join(self.TMP_DIR, 'main.sqlite')
+
+        def run(env, *argv):
+            self.reset_output()
+            ctx.context(('ctx',) + argv, env, self.stdout, self.stderr,
+                        _now=NOW)
+            return self.stdout.getvalue()
+
+        def assert_unlocked():
+            db = sqlite3.connect(path, timeout=0, isolation_level=None)
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute('ROLLBACK')
+            finally:
+                db.close()
+
+        run(env, 'set', 'a', '1')
+        txn = dict(env, CTX_TXN=run(env, 'txn', 'begin').strip())
+        run(txn, 'set', 'b', '2')
+        self.assertEqual(run(txn, 'keys'), 'a\nb\n')
+        assert_unlocked()
+
+        # changes are only written, under the lock, by flush()
+        c = ctx.Context(environ=env)
+        c['c'] = '3'
+        self.assertEqual(c.keys(), ['a', 'c'])
+        assert_unlocked()
+        c.flush()
+        c.close()
+        assert_unlocked()
+        self.assertEqual(run(env, 'keys'), 'a\nc\n')
+        run(txn, 'txn', 'commit')
+        self.assertEqual(run(env, 'keys'), 'a\nb\nc\n')
+
+    def test_migrate(self):
+        ctx.context(('ctx', 'set', 'a', '1'), self.environ,
+                    self.stdout, self.stderr, _now=NOW)
+
+        ctx.context(('ctx', 'migrate', 'sqlite'), self.environ,
+                    self.stdout, self.stderr, _now=NOW)
+        self.assertFalse(os.path.exists(self._ctx_file))
+
+        self.reset_output()
+        ctx.context(('ctx', 'get', 'a'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), '1\n')
+
+        ctx.context(('ctx', 'migrate', 'json'), self.environ,
+                    self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(self.load_ctx('main'), {'a': [NOW, '1']})
+
+        self.reset_output()
+        ctx.context(('ctx', 'log'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(len(self.stdout.getvalue().splitlines()), 3)
+
+    def test_snapshot(self):
+        env = self.environ.copy()
+        env['CTX_SNAPSHOT_MIN'] = '2'
+        snap_file = os.path.join(self.TMP_DIR, 'main.snap')
+
+        def get(key):
+            self.reset_output()
+            ctx.context(('ctx', 'get', key), env, self.stdout, self.stderr)
+            return self.stdout.getvalue()
+
+        ctx.context(('ctx', 'set', 'a', '1'), env,
+                    self.stdout, self.stderr, _now=NOW)
+        self.assertFalse(os.path.exists(snap_file))
+
+        ctx.context(('ctx', 'set', 'b', 'two words'), env,
+                    self.stdout, self.stderr, _now=NOW)
+        self.assertTrue(os.path.exists(snap_file))
+
+        backend = ctx.JsonBackend(self.TMP_DIR, 'main', env)
+        self.assertEqual(backend['b'], [NOW, 'two words'])
+        self.assertNotIn('c', backend)
+        self.assertIsNone(backend._data)  # answered by the snapshot
+
+        self.assertEqual(get('a'), '1\n')
+        self.assertRaises(KeyError, get, 'c')
+
+        # a snapshot of an older file is not used, and is refreshed
+        self.write_ctx({'a': [NOW, 'x'], 'c': [NOW, 'y']})
+        self.assertEqual(get('a'), 'x\n')
+        self.assertEqual(get('c'), 'y\n')
+
+        backend = ctx.JsonBackend(self.TMP_DIR, 'main', env)
+        self.assertEqual(backend['c'], [NOW, 'y'])
+        self.assertIsNone(backend._data)
+
+    def test_cache(self):
+        env = self.environ.copy()
+        env['CTX_CACHE'] = '1'
+        cache_file = os.path.join(self.TMP_DIR, '_cache', 'main.marshal')
+
+        self.write_ctx({'a': [NOW, 'aaa']})
+        ctx.context(('ctx', 'get', 'a'), env, self.stdout, self.stderr)
+        self.assertTrue(os.path.exists(cache_file))
+
+        # the cache is used while the file is unchanged
+        sig = ctx._file_sig(self._ctx_file)
+        ctx._write_cache(cache_file, sig, {'a': [NOW, 'cached']})
+        self.reset_output()
+        ctx.context(('ctx', 'get', 'a'), env, self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), 'cached\n')
+
+        # and is refreshed once the file changes
+        self.write_ctx({'a': [NOW, 'bbb'], 'b': [NOW, 'ccc']})
+        self.reset_output()
+        ctx.context(('ctx', 'items'), env, self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), 'a=bbb\nb=ccc\n')
+        sig = ctx._file_sig(self._ctx_file)
+        self.assertEqual(ctx._read_cache(cache_file, sig),
+                         {'a': [NOW, 'bbb'], 'b': [NOW, 'ccc']})
+
+    def test_chain(self):
+        env = self.environ.copy()
+        env['CTX_NAME'] = 'a+b+c'
+        self.write_ctx({'x': [NOW, 'ax']}, 'a')
+        self.write_ctx({'x': [NOW, 'bx'], 'y': [NOW, 'by']}, 'b')
+        merged_file = os.path.join(self.TMP_DIR, '_cache', 'a+b+c.merged')
+
+        # a hit in the first context does not read the others
+        cdict = ctx.collections.ChainMap(
+            *[ctx.JsonBackend(self.TMP_DIR, n, env) for n in 'abc'])
+        self.assertEqual(cdict['x'], [NOW, 'ax'])
+        self.assertIsNone(cdict.maps[1]._data)
+        self.assertEqual(cdict['y'], [NOW, 'by'])
+        self.assertIsNone(cdict.maps[2]._data)
+
+        ctx.context(('ctx', 'items'), env, self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), 'x=ax\ny=by\n')
+        self.assertTrue(os.path.exists(merged_file))
+
+        # the merged view is rebuilt when a chained context changes
+        self.write_ctx({'z': [NOW, 'cz']}, 'c')
+        self.reset_output()
+        ctx.context(('ctx', 'keys'), env, self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), 'x\ny\nz\n')
+
+        # changes go to the first context
+        ctx.context(('ctx', 'set', 'y', 'ay'), env,
+                    self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(self.load_ctx('a'),
+                         {'x': [NOW, 'ax'], 'y': [NOW, 'ay']})
+        self.reset_output()
+        ctx.context(('ctx', 'items'), env, self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), 'x=ax\ny=ay\nz=cz\n')
+
+    def test_profile(self):
+        self.environ['CTX_PROFILE'] = '1'
+        ctx.context(('ctx', 'set', 'a', 'aaa'), self.environ,
+                    self.stdout, self.stderr, _now=NOW)
+        err = self.stderr.getvalue()
+        self.assertIn('ctx profile: set a aaa', err)
+        for phase in ('name', 'command set', 'serialize', 'write', 'log',
+                      'imports', 'total'):
+            self.assertIn('  %s ' % phase, err)
+        self.assertIsNone(ctx._profile)
+
+        prof_file = os.path.join(self.TMP_DIR, 'profile.jsonl')
+        stats_file = os.path.join(self.TMP_DIR, 'profile.stats')
+        self.environ['CTX_PROFILE'] = prof_file
+        self.environ['CTX_PROFILE_STATS'] = stats_file
+        ctx.context(('ctx', 'get', 'a'), self.environ,
+                    self.stdout, self.stderr, _now=NOW)
+        with open(prof_file, 'r') as fid:
+            rec = json.loads(fid.readline())
+        self.assertEqual(rec['argv'], ['get', 'a'])
+        phases = {phase: nbytes for phase, ms, nbytes in rec['phases']}
+        self.assertEqual(phases['read main.json'],
+                         os.path.getsize(self._ctx_file))
+        self.assertTrue(os.path.exists(stats_file))
+
+    def test_key_index(self):
+        index_file = os.path.join(self.TMP_DIR, 'main.keys')
+
+        def index():
+            with open(index_file) as fid:
+                header = fid.readline()
+                return header, fid.read().splitlines()
+
+        for k in ('b', 'c', 'a'):
+            ctx.context(('ctx', 'set', k, 'v'), self.environ,
+                        self.stdout, self.stderr)
+        header, keys = index()
+        self.assertEqual(keys, ['a', 'b', 'c'])
+        self.assertEqual(header, '#ctxkeys %r\n' % (
+            ctx._file_sig(self._ctx_file),))
+
+        ctx.context(('ctx', 'del', 'b'), self.environ,
+                    self.stdout, self.stderr)
+        ctx.context(('ctx', 'set', 'c', 'new'), self.environ,
+                    self.stdout, self.stderr)
+        header, keys = index()
+        self.assertEqual(keys, ['a', 'c'])
+        self.assertIn(repr(ctx._file_sig(self._ctx_file)), header)
+
+        # `ctx keys` is answered from the index, without decoding the file
+        import unittest.mock
+        self.reset_output()
+        with unittest.mock.patch.object(ctx, '_load_json') as load:
+            ctx.context(('ctx', 'keys'), self.environ,
+                        self.stdout, self.stderr)
+        load.assert_not_called()
+        self.assertEqual(self.stdout.getvalue(), 'a\nc\n')
+
+    def test_key_query(self):
+        import random
+        rnd = random.Random(0)
+        keys = set('%s_%i' % (rnd.choice(['host', 'hostx', '_note', 'a']),
+                              rnd.randrange(500)) for i in range(300))
+        keys.update(['host', 'h\u00e9te', ''])
+        self.write_ctx({k: [NOW, 'v'] for k in keys})
+        ctx.context(('ctx', 'set', 'host_new', 'v'), self.environ,
+                    self.stdout, self.stderr)
+        keys.add('host_new')
+
+        index_file = os.path.join(self.TMP_DIR, 'main.keys')
+        sig = ctx._file_sig(self._ctx_file)
+        for prefix in ('', 'host', 'host_', 'host_4', 'hostx_1', '_note',
+                       'h\u00e9', 'zzz', 'a_49', '\x00'):
+            expect = sorted(k for k in keys if k.startswith(prefix))
+            self.assertEqual(ctx._index_prefix(index_file, sig, prefix),
+                             expect, prefix)
+        self.assertIsNone(ctx._index_prefix(index_file, (0, 0, 0), 'a'))
+
+        def keys_out(*args):
+            self.reset_output()
+            ctx.context(('ctx', 'keys') + args, self.environ,
+                        self.stdout, self.stderr)
+            return self.stdout.getvalue().splitlines()
+
+        self.assertEqual(keys_out('--prefix', 'host_1'),
+                         sorted(k for k in keys if k.startswith('host_1')))
+        self.assertEqual(keys_out('--glob', 'host*_4?'),
+                         sorted(k for k in keys if k.startswith(('host_4',
+                                'hostx_4')) and len(k) == len('host_4') + 1
+                                + k.startswith('hostx')))
+        self.assertEqual(keys_out('--regex', '^hostx?_1+$'),
+                         [k for k in ('host_1', 'host_11', 'host_111',
+                                      'hostx_1', 'hostx_11', 'hostx_111')
+                          if k in keys])
+
+        # the newest of the matching items last
+        self.reset_output()
+        ctx.context(('ctx', 'items', '--match', 'host_*'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue().splitlines()[-1],
+                         'host_new=v')
+
+    def test_completion(self):
+        import shutil
+        import subprocess
+        root = os.path.dirname(os.path.dirname(ctx.__file__))
+        for shell, name in (('bash', 'ctx.bash'), ('zsh', '_ctx')):
+            self.reset_output()
+            ctx.context(('ctx', '_completion', shell), self.environ,
+                        self.stdout, self.stderr)
+            with open(os.path.join(root, 'completion', name)) as fid:
+                self.assertEqual(fid.read(), self.stdout.getvalue(),
+                                 'regenerate completion/%s' % name)
+
+        bash = shutil.which('bash')
+        if bash is None:
+            return
+        self.write_ctx({'other': [NOW, '1']}, name='base')
+        for k in ('alpha', 'beta', 'alps'):
+            ctx.context(('ctx', 'set', k, 'v'), self.environ,
+                        self.stdout, self.stderr)
+        script = os.path.join(root, 'completion', 'ctx.bash')
+        test = ('source "$0"; COMP_WORDS=("$@"); '
+                'COMP_CWORD=$(( ${#COMP_WORDS[@]} - 1 )); _ctx; '
+                'printf "%s\\n" "${COMPREPLY[@]}"')
+
+        def complete(*words):
+            env = dict(self.environ, PATH=os.environ['PATH'],
+                       CTX_NAME='main+base')
+            out = subprocess.check_output(
+                [bash, '-c', test, script] + list(words), env=env)
+            return sorted(out.decode('utf8').split())
+
+        self.assertEqual(complete('ctx', 'get', 'al'), ['alpha', 'alps'])
+        self.assertEqual(complete('ctx', 'del', 'x', ''),
+                         ['alpha', 'alps', 'beta'])
+        self.assertEqual(complete('ctx', 'switch', ''), ['base', 'main'])
+        self.assertIn('waitpid', complete('ctx', 'w'))
+
     def test_now(self):
         ctx.context(('ctx', 'now'), self.environ,
                     self.stdout, self.stderr,
@@ -177,6 +820,246 @@ class TestContext(unittest.TestCase):
 
 
 
+    def test_batch(self):
+        bfile = os.path.join(self.TMP_DIR, 'batch.txt')
+        with open(bfile, 'w') as fid:
+            fid.write(
+"""set a 1
+set b "two words"
+# comment
+get b
+get MISSING
+del a
+entry note first
+""")
+        status = ctx.context(('ctx', 'batch', bfile), self.environ,
+                             self.stdout, self.stderr,
+                             _now=NOW,
+                             _color=False)
+        self.assertEqual(status, 1)
+        self.assertEqual(self.stdout.getvalue(),
+                         'two words\nnote_001=first\n')
+        self.assertEqual(self.stderr.getvalue(),
+                         "batch command 4 failed: KeyError: 'MISSING'\n")
+
+        v = self.load_ctx('main')
+        self.assertEqual(v, {'b': [NOW, 'two words'],
+                             'note_001': [NOW, 'first']})
+
+        self.reset_output()
+        ctx.context(('ctx', 'log'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(
+            self.stdout.getvalue().splitlines()[0],
+            "['%s', 'batch', '%s', None]" % (NOW, bfile))
+        self.assertEqual(len(self.stdout.getvalue().splitlines()), 5)
+
+        # NUL-terminated arguments
+        with open(bfile, 'w') as fid:
+            fid.write('set\0c\0x\ny\0\0get\0c\0\0')
+        self.reset_output()
+        status = ctx.context(('ctx', 'batch', '-0', bfile), self.environ,
+                             self.stdout, self.stderr,
+                             _now=NOW,
+                             _color=False)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.stdout.getvalue(), 'x\ny\n')
+
+        # execvp would replace the process before the batch is stored
+        import unittest.mock
+        with open(bfile, 'w') as fid:
+            fid.write('set e "echo hi"\nexecvp e\nset f 2\n')
+        self.reset_output()
+        with unittest.mock.patch.object(ctx.os, 'execve') as execve:
+            status = ctx.context(('ctx', 'batch', bfile), self.environ,
+                                 self.stdout, self.stderr, _now=NOW)
+        execve.assert_not_called()
+        self.assertEqual(status, 1)
+        self.assertEqual(self.stderr.getvalue(),
+                         'batch command 2 failed: '
+                         'ValueError: execvp cannot run in a batch\n')
+        self.assertEqual(self.load_ctx('main')['f'], [NOW, '2'])
+
+    def test_batch_failed(self):
+        # a failed command leaves nothing behind in the batch
+        import unittest.mock
+        env = dict(self.environ, CTX_NAME='main+base')
+        self.write_ctx({'a': [NOW, '1']})
+        self.write_ctx({'k': [NOW, 'base']}, 'base')
+        bfile = os.path.join(self.TMP_DIR, 'batch.txt')
+        with open(bfile, 'w') as fid:
+            fid.write('rename k k2\nset bad 2\nset b 3\n')
+
+        record = ctx.Context.record
+
+        def failing_record(c, records):
+            records = list(records)
+            if records and records[0][2] == 'bad':
+                raise RuntimeError('no log')
+            record(c, records)
+
+        with unittest.mock.patch.object(ctx.Context, 'record',
+                                        failing_record):
+            status = ctx.context(('ctx', 'batch', bfile), env,
+                                 self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(status, 1)
+        self.assertEqual(self.stderr.getvalue().splitlines(), [
+            "batch command 1 failed: KeyError: "
+            "\"Key not found in the first mapping: 'k'\"",
+            'batch command 2 failed: RuntimeError: no log'])
+        self.assertEqual(self.load_ctx('main'),
+                         {'a': [NOW, '1'], 'b': [NOW, '3']})
+
+        import ast
+        self.reset_output()
+        ctx.context(('ctx', 'log'), env, self.stdout, self.stderr)
+        self.assertEqual([ast.literal_eval(line)[1:3]
+                          for line in self.stdout.getvalue().splitlines()],
+                         [['batch', bfile], ['set', 'b']])
+
+    def test_del_multiple(self):
+        self.write_ctx({'a': [NOW, 'aaa'], 'b': [NOW, 'bbb']})
+
+        # nothing is deleted if a key is missing
+        with self.assertRaises(KeyError):
+            ctx.context(('ctx', 'del', 'a', 'MISSING'), self.environ,
+                        self.stdout, self.stderr)
+        self.assertEqual(len(self.load_ctx('main')), 2)
+
+        ctx.context(('ctx', 'del', 'a', 'b'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(self.load_ctx('main'), {})
+
+    def test_txn(self):
+        self.write_ctx({'a': [NOW, 'aaa'], 'b': [NOW, 'bbb']})
+
+        # single invocation, all or nothing
+        bfile = os.path.join(self.TMP_DIR, 'txn.txt')
+        with open(bfile, 'w') as fid:
+            fid.write('set c ccc\ndel a\nget MISSING\nset d ddd\n')
+        status = ctx.context(('ctx', 'txn', bfile), self.environ,
+                             self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(status, 1)
+        self.assertEqual(self.stderr.getvalue().splitlines()[-1],
+                         'transaction aborted, nothing stored')
+        self.assertEqual(len(self.load_ctx('main')), 2)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.TMP_DIR, 'main.log')))
+
+        with open(bfile, 'w') as fid:
+            fid.write('set c ccc\ndel a\n')
+        status = ctx.context(('ctx', 'txn', bfile), self.environ,
+                             self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(self.load_ctx('main')), ['b', 'c'])
+
+        # staged over several invocations
+        self.reset_output()
+        ctx.context(('ctx', 'txn', 'begin'), self.environ,
+                    self.stdout, self.stderr)
+        env = self.environ.copy()
+        env['CTX_TXN'] = self.stdout.getvalue().strip()
+
+        ctx.context(('ctx', 'set', 'x', '1'), env,
+                    self.stdout, self.stderr, _now=NOW)
+        ctx.context(('ctx', 'del', 'b'), env,
+                    self.stdout, self.stderr, _now=NOW)
+
+        # not visible outside of the transaction
+        self.assertEqual(sorted(self.load_ctx('main')), ['b', 'c'])
+
+        # a one-shot transaction does not commit the open one
+        with open(bfile, 'w') as fid:
+            fid.write('set y 2\n')
+        with self.assertRaises(ValueError):
+            ctx.context(('ctx', 'txn', bfile), env,
+                        self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(sorted(self.load_ctx('main')), ['b', 'c'])
+
+        self.reset_output()
+        ctx.context(('ctx', 'keys'), env, self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), 'c\nx\n')
+
+        ctx.context(('ctx', 'txn', 'commit'), env,
+                    self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(sorted(self.load_ctx('main')), ['c', 'x'])
+
+        # the transaction is gone after the commit
+        with self.assertRaises(ValueError):
+            ctx.context(('ctx', 'get', 'x'), env, self.stdout, self.stderr)
+
+        # and an aborted transaction changes nothing
+        self.reset_output()
+        ctx.context(('ctx', 'txn', 'begin'), self.environ,
+                    self.stdout, self.stderr)
+        env['CTX_TXN'] = self.stdout.getvalue().strip()
+        ctx.context(('ctx', 'set', 'y', '1'), env,
+                    self.stdout, self.stderr, _now=NOW)
+        ctx.context(('ctx', 'txn', 'abort'), env,
+                    self.stdout, self.stderr, _now=NOW)
+        self.assertEqual(sorted(self.load_ctx('main')), ['c', 'x'])
+
+    def test_txn_staged(self):
+        self.write_ctx({'a': [NOW, 'aaa'], 'b': [NOW, 'bbb']})
+        backend = ctx._open_backend(self.TMP_DIR, 'main', self.environ)
+        staged = ctx._Staged(backend, {'c': [NOW, 'ccc']}, ['a'])
+        staged['d'] = (NOW, 'ddd')
+        del staged['b']
+        self.assertEqual(sorted(staged), ['c', 'd'])
+        self.assertEqual(staged.prefix_keys(''), ['c', 'd'])
+        self.assertNotIn('a', staged)
+        with self.assertRaises(KeyError):
+            del staged['b']
+        self.assertEqual(staged.changes(),
+                         ({'c': [NOW, 'ccc'], 'd': [NOW, 'ddd']}, ['a', 'b']))
+
+        # the context is only written when the transaction is committed
+        self.assertFalse(backend.changed)
+        self.assertEqual(sorted(backend), ['a', 'b'])
+        staged.flush([(NOW, 'txn', 'commit', None)])
+        self.assertEqual(sorted(self.load_ctx('main')), ['c', 'd'])
+
+    def test_context_api(self):
+        self.write_ctx({'a': [NOW, 'aaa']})
+        self.write_ctx({'low': [NOW, 'lll']}, name='base')
+
+        c = ctx.Context('main+base', environ=self.environ)
+        self.assertEqual(c['a'], 'aaa')
+        self.assertEqual(c['low'], 'lll')
+        self.assertEqual(c.keys(), ['a', 'low'])
+        self.assertFalse(c.dirty)
+
+        NOW2 = (NOW_DT + datetime.timedelta(days=1)).isoformat()
+        c.set('b', 'bbb', now=NOW2)
+        c.update([('c', 'ccc'), ('d', 'ddd')], now=NOW2)
+        c.delete('a', now=NOW2)
+        self.assertTrue(c.dirty)
+        self.assertEqual([k for k, v in c.items()], ['low', 'b', 'c', 'd'])
+
+        # nothing is stored before the flush
+        self.assertEqual(list(self.load_ctx('main')), ['a'])
+        c.flush()
+        self.assertFalse(c.dirty)
+        self.assertEqual(sorted(self.load_ctx('main')), ['b', 'c', 'd'])
+        self.assertEqual(self.load_ctx('base'), {'low': [NOW, 'lll']})
+
+        # the log matches the command line
+        log = list(c.backend.iter_log())
+        self.assertEqual([rec[1] for rec in log],
+                         ['set', 'update', 'update_set', 'update_set', 'del'])
+        self.assertEqual(log[-1], [NOW2, 'del', 'a', None])
+
+        # a failed block stores nothing
+        with self.assertRaises(KeyError):
+            with ctx.Context(environ=self.environ) as c:
+                c['e'] = 'eee'
+                del c['MISSING']
+        self.assertNotIn('e', self.load_ctx('main'))
+
+        with ctx.Context(environ=self.environ) as c:
+            c['e'] = 'eee'
+        self.assertEqual(self.load_ctx('main')['e'][1], 'eee')
+
     def test_clear(self):
 
         d = {'a': [NOW, 'aaa'],
@@ -237,6 +1120,59 @@ class TestContext(unittest.TestCase):
         self.assertTrue('1971-01-01' in out)
 
 
+    def test_fullitems_page(self):
+        # the newest items, skipping and limiting as for paging
+        d = {'k%i' % i: ['197%i' % i + NOW[4:], 'v%i' % i]
+             for i in range(6)}
+        self.write_ctx(d)
+        env = dict(self.environ, CTX_NAME='lite')
+        self.write_ctx(d, 'lite')
+        ctx.context(('ctx', 'migrate', 'sqlite'), env,
+                    io.StringIO(), io.StringIO())
+
+        for environ in (self.environ, env):
+            self.reset_output()
+            ctx.context(('ctx', '--limit', '2', '--offset', '1'), environ,
+                        self.stdout, self.stderr, _color=False)
+            out = self.stdout.getvalue().splitlines()
+            self.assertIn('There are 6 entries.', out)
+            self.assertEqual([i.split()[1] for i in out[3:]], ['k4', 'k3'])
+
+            self.reset_output()
+            ctx.context(('ctx', 'items', '--before', '1973', '--limit', '2'),
+                        environ, self.stdout, self.stderr, _color=False)
+            self.assertEqual(self.stdout.getvalue(), 'k1=v1\nk2=v2\n')
+
+        self.assertRaises(ValueError, ctx.context,
+                          ('ctx', 'items', '--limit', '-1'), self.environ,
+                          self.stdout, self.stderr)
+
+    def test_format(self):
+        d = {'a': [NOW, 'x=1\ny\tz\\'],
+             'b': ['1971' + NOW[4:], 'bbb'],
+             }
+        self.write_ctx(d)
+        T = '1971' + NOW[4:]
+
+        def run(*args):
+            self.reset_output()
+            ctx.context(('ctx',) + args, self.environ,
+                        self.stdout, self.stderr, _color=True)
+            return self.stdout.getvalue()
+
+        self.assertEqual(json.loads(run('items', '--format', 'json')),
+                         [['a', d['a'][1]], ['b', 'bbb']])
+        self.assertEqual(run('keys', '--format', 'jsonl'), '"a"\n"b"\n')
+        self.assertEqual(run('items', 'b', 'a', '--format', 'nul'),
+                         'b\0bbb\0a\0x=1\ny\tz\\\0')
+        self.assertEqual(run('--format', 'tsv', '--limit', '1'),
+                         T + '\tb\tbbb\n')
+        self.assertEqual(run('_fullitems', '--offset', '1', '--format', 'tsv'),
+                         NOW + '\ta\tx=1\\ny\\tz\\\\\n')
+        self.assertEqual(run('keys', '--prefix', 'z', '--format', 'json'),
+                         '[]\n')
+        self.assertRaises(ValueError, run, 'keys', '--format', 'xml')
+
     def test_rename(self):
         d = {'a': [NOW, 'aaa'],
              'b': ['1971' + NOW[4:], 'bbb'],
@@ -354,6 +1290,20 @@ C=3
         self.assertTrue('B' in v)
         self.assertTrue('C' in v)
 
+        # unique timestamps preserve the order of the lines
+        self.assertEqual(v['A'][0], NOW)
+        self.assertTrue(v['A'][0] < v['B'][0] < v['C'][0])
+
+        self.reset_output()
+        ctx.context(('ctx', 'items'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(), 'A=1\nB=2\nC=3\n')
+
+        self.reset_output()
+        ctx.context(('ctx', 'log'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(len(self.stdout.getvalue().splitlines()), 4)
+
         # FIXME: test sys.stdin with "-"
 
 
@@ -376,6 +1326,110 @@ C=3
             "['1970-01-01T00:00:00.123456', 'set', 'abc', '123']\n"
             )
 
+    def test_log_legacy(self):
+        # an array-format log is migrated to JSON Lines on append
+        log_file = os.path.join(self.TMP_DIR, 'main.log')
+        with open(log_file, 'w') as fid:
+            json.dump([[NOW, 'set', 'a', '1']], fid, indent=4)
+
+        ctx.context(('ctx', 'set', 'b', '2'), self.environ,
+                    self.stdout, self.stderr,
+                    _now=NOW,
+                    _color=False)
+
+        with open(log_file, 'r') as fid:
+            lines = fid.read().splitlines()
+        self.assertEqual(
+            [json.loads(i) for i in lines],
+            [[NOW, 'set', 'a', '1'], [NOW, 'set', 'b', '2']]
+            )
+
+        ctx.context(('ctx', 'log'), self.environ,
+                    self.stdout, self.stderr)
+        out = self.stdout.getvalue()
+        self.assertEqual(len(out.splitlines()), 2)
+
+    def test_log_partial_first(self):
+        # a first record cut short is dropped, not taken for a legacy log
+        log_file = os.path.join(self.TMP_DIR, 'main.log')
+        with open(log_file, 'w') as fid:
+            fid.write('["1970-01-01T00:00:01", "se')
+
+        ctx.context(('ctx', 'set', 'b', '2'), self.environ,
+                    self.stdout, self.stderr, _now=NOW)
+        ctx.context(('ctx', 'log'), self.environ,
+                    self.stdout, self.stderr)
+        self.assertEqual(self.stdout.getvalue(),
+                         str([NOW, 'set', 'b', '2']) + '\n')
+
+    def test_log_tail_since(self):
+        for n in range(10):
+            now = '1970-01-01T00:00:%02i' % n
+            ctx.context(('ctx', 'set', 'k%i' % n, str(n)), self.environ,
+                        self.stdout, self.stderr,
+                        _now=now,
+                        _color=False)
+
+        ctx.context(('ctx', 'log', '--tail', '2'), self.environ,
+                    self.stdout, self.stderr)
+        out = self.stdout.getvalue()
+        self.assertEqual(
+            out,
+            "['1970-01-01T00:00:08', 'set', 'k8', '8']\n"
+            "['1970-01-01T00:00:09', 'set', 'k9', '9']\n"
+            )
+
+        for n in range(11):
+            self.reset_output()
+            since = '1970-01-01T00:00:%02i' % n
+            ctx.context(('ctx', 'log', '--since', since), self.environ,
+                        self.stdout, self.stderr)
+            lines = self.stdout.getvalue().splitlines()
+            self.assertEqual(len(lines), 10 - n)
+
+        self.reset_output()
+        ctx.context(('ctx', 'log', '--since', '1970-01-01T00:00:03',
+                     '--tail', '1'), self.environ,
+                    self.stdout, self.stderr)
+        out = self.stdout.getvalue()
+        self.assertEqual(out, "['1970-01-01T00:00:09', 'set', 'k9', '9']\n")
+
+    def test_log_since_unordered(self):
+        # a transaction appends the records it staged earlier, which
+        # --since must still find, with or without the log index
+        T = '1970-01-01T00:00:%02i'
+
+        def run(argv, environ=self.environ, now=None):
+            self.reset_output()
+            ctx.context(('ctx',) + argv, environ, self.stdout, self.stderr,
+                        _now=now)
+            return self.stdout.getvalue()
+
+        run(('set', 'a', '1'), now=T % 1)
+        env = dict(self.environ, CTX_TXN=run(('txn', 'begin')).strip())
+        run(('set', 'b', '2'), env, now=T % 2)
+        run(('set', 'c', '3'), now=T % 3)
+        run(('txn', 'commit'), env, now=T % 4)
+
+        expected = [[T % 3, 'set', 'c', '3'], [T % 4, 'txn', 'commit']]
+        idx_file = os.path.join(self.TMP_DIR, 'main.logidx')
+        for rebuild in (False, True):
+            if rebuild:
+                os.remove(idx_file)
+            out = run(('log', '--since', T % 3)).splitlines()
+            self.assertEqual([eval(i)[:len(e)] for i, e in
+                              zip(out, expected)], expected)
+            self.assertEqual(len(out), 2)
+            self.assertEqual(run(('log', '--since', T % 5)), '')
+
+        # the index is rebuilt on the next append
+        run(('set', 'd', '4'), now=T % 5)
+        self.assertTrue(os.path.exists(idx_file))
+        self.assertEqual(len(run(('log', '--since', T % 2)).splitlines()), 4)
+        self.assertEqual(ctx._log_index_start(
+            os.path.join(self.TMP_DIR, 'main.log'), T % 5),
+            ctx._log_index_last(idx_file)[1])
+
     def test_entry(self):
         ctx.context(('ctx', 'entry', 'note', 'a', 'b', 'c'), self.environ,
                     self.stdout, self.stderr,
@@ -405,6 +1459,43 @@ C=3
         self.assertEqual(out, 'note_002=more\n')
 
 
+    def test_entry_counter(self):
+        # concurrent entries get distinct numbers from the stored counter
+        import threading
+
+        def worker():
+            for i in range(10):
+                ctx.context(('ctx', 'entry', 'note', 'x'), self.environ,
+                            io.StringIO(), io.StringIO(), _now=NOW)
+
+        threads = [threading.Thread(target=worker) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        v = self.load_ctx('main')
+        self.assertEqual(sorted(v), ['note_%03i' % i for i in range(1, 41)])
+
+        # a missing counter is rebuilt from the keys, numbers set by hand
+        # are skipped
+        os.remove(os.path.join(self.TMP_DIR, 'main.counters'))
+        for argv in [('ctx', 'del', 'note_040'),
+                     ('ctx', 'entry', 'note', 'y'),
+                     ('ctx', 'set', 'note_041', 'z'),
+                     ('ctx', 'entry', 'note', 'y')]:
+            self.reset_output()
+            ctx.context(argv, self.environ, self.stdout, self.stderr,
+                        _now=NOW, _color=False)
+        self.assertEqual(self.stdout.getvalue(), 'note_042=y\n')
+
+        env = dict(self.environ, CTX_BACKEND='sqlite', CTX_NAME='lite')
+        for out in ['note_001=a\n', 'note_002=b\n']:
+            self.reset_output()
+            ctx.context(('ctx', 'entry', 'note', out[-2]), env,
+                        self.stdout, self.stderr, _now=NOW, _color=False)
+            self.assertEqual(self.stdout.getvalue(), out)
+
     def test_exec(self):
         d = {'a': [NOW, 'aaa'],
              'b': [NOW, 'bbb'],
@@ -420,6 +1511,34 @@ C=3
         self.assertEqual(out, "dryrun exec command: ['aaa', '1234']\n")
 
 
+    @unittest.skipIf(os.name == 'nt', 'no execvp on Windows')
+    def test_execvp(self):
+        import subprocess
+        bin_dir = os.path.join(self.TMP_DIR, 'bin')
+        os.mkdir(bin_dir)
+        tool = os.path.join(bin_dir, 'ctx-test-tool')
+        with open(tool, 'w') as fid:
+            fid.write('#!/bin/sh\necho "$@"; exit 7\n')
+        os.chmod(tool, 0o755)
+
+        env = {'PATH': bin_dir + os.pathsep + os.defpath}
+        self.assertEqual(ctx._resolve_exec('ctx-test-tool', self.TMP_DIR, env),
+                         tool)
+        with open(os.path.join(self.TMP_DIR, '_cache', 'execpath.json')) as fid:
+            self.assertEqual(json.load(fid)['ctx-test-tool'][0], tool)
+        self.assertIsNone(ctx._resolve_exec('ctx-no-such-tool',
+                                            self.TMP_DIR, env))
+
+        # the exit status and output of the command pass through
+        self.write_ctx({'tool': [NOW, 'ctx-test-tool -x']})
+        env.update(self.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(ctx.__file__))
+        proc = subprocess.run(
+            [sys.executable, '-m', 'shellctx.ctx', 'execvp', 'tool', 'y'],
+            env=env, stdout=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 7)
+        self.assertEqual(proc.stdout, b'-x y\n')
+
     def test_shell(self):
         d = {'a': [NOW, 'aaa'],
              'b': [NOW, 'bbb'],